@@ -0,0 +1,160 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+import matplotlib
+matplotlib.use('Agg')  # batch runs are non-interactive
+import pandas as pd
+
+import render_workers
+import stage_profiler
+
+from checkpoint import CheckpointJournal
+from design import Design, default_design
+from figure_export import FORMATS
+from gene_stats import GeneStats
+from mapped_store import MappedStore
+from render_cache import RenderManifest
+from stage_profiler import stage, traced_gene
+from tpm_boxplot import output_basename, render_params
+
+
+def _render_gene(gene_id, stats=None):
+    start = time.perf_counter()
+    try:
+        with traced_gene(gene_id):
+            filename_base = render_workers.template.render(render_workers.store, gene_id, exporter=render_workers.exporter, key=gene_id,
+                                                           stats=stats, backend=render_workers.backend)
+        # an unknown ID is a failure, so it never ends up in the checkpoint journal or manifest as done
+        error = None if filename_base is not None else "not in the TPM/p-value tables"
+    except Exception:
+        # Keep going with the other genes, the caller gets the traceback
+        error = traceback.format_exc()
+        render_workers.template.reset()
+    return gene_id, error, time.perf_counter() - start
+
+
+def _render_chunk(gene_ids):
+    # Files of one gene are written while the next one is drawn, the chunk
+    # only returns once everything is on disk so no write error gets lost.
+    # Box statistics of the chunk's rows only: no worker holds a copy of the whole table.
+    start = time.perf_counter()
+    try:
+        with stage('precompute'):
+            found = [gene_id for gene_id in gene_ids if gene_id in render_workers.store]
+            stats = GeneStats.from_store(render_workers.store, found) if found else None
+    except Exception:
+        # reported for every gene of the chunk instead of ending the whole run
+        error = traceback.format_exc()
+        return [(gene_id, error, time.perf_counter() - start) for gene_id in gene_ids]
+    results = [_render_gene(gene_id, stats) for gene_id in gene_ids]
+    write_errors = render_workers.exporter.wait()
+    # stages of the writer threads
+    stage_profiler.flush()
+    for i, (gene_id, error, elapsed) in enumerate(results):
+        if error is None and gene_id in write_errors:
+            path, write_error = write_errors[gene_id]
+            results[i] = (gene_id, f"Writing {path} failed: {write_error!r}", elapsed)
+    return results
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def read_gene_ids(pval_file):
+    # Only the ID column is needed to build the work list
+    return pd.read_csv(pval_file, sep="\t", usecols=['ID'], dtype=str)['ID'].dropna().unique().tolist()
+
+
+def render_all_genes(tpm_file, pval_file, gene_ids=None, workers=None, chunksize=4, progress_every=100, max_rss_mb=None, formats=FORMATS, manifest_file=None, backend='seaborn', design=None, mapped=False, checkpoint_file=None):
+    if gene_ids is None:
+        gene_ids = read_gene_ids(pval_file)
+
+    journal = None
+    if checkpoint_file is not None:
+        # Genes completed by an earlier (killed) run with the same settings are not rendered again
+        journal = CheckpointJournal(checkpoint_file, render_params(formats, backend, design if design is not None else default_design))
+        requested = len(gene_ids)
+        gene_ids = journal.remaining(gene_ids)
+        if requested > len(gene_ids):
+            print(f"Resuming {checkpoint_file}: {requested - len(gene_ids)} of {requested} genes already done")
+    if mapped:
+        # Written once here so the workers only open it
+        MappedStore.from_files(tpm_file, pval_file, design=design)
+
+    manifest = None
+    if manifest_file is not None:
+        # Only genes whose data, plot settings or output files changed since the last run are rendered
+        store = render_workers.open_store(tpm_file, pval_file, design, mapped)
+        manifest = RenderManifest(manifest_file)
+        params = render_params(formats, backend, store.design)
+        requested = len(gene_ids)
+        gene_ids = manifest.stale(store, gene_ids, output_basename, params)
+        print(f"{requested - len(gene_ids)} of {requested} genes are up to date")
+
+    workers = workers or os.cpu_count() or 1
+    total = len(gene_ids)
+    failed = {}
+
+    print(f"Rendering {total} genes with {workers} worker(s)")
+    start = time.perf_counter()
+    if total == 0:
+        if journal is not None:
+            journal.close()
+        return failed
+    with multiprocessing.Pool(workers, initializer=render_workers.init_worker,
+                              initargs=(tpm_file, pval_file, design, mapped, backend, max_rss_mb, formats)) as pool:
+        done = 0
+        for results in pool.imap_unordered(_render_chunk, _chunks(list(gene_ids), chunksize)):
+            for gene_id, error, _ in results:
+                done += 1
+                if error is not None:
+                    failed[gene_id] = error
+                    print(f"FAILED {gene_id}:\n{error}", file=sys.stderr)
+                else:
+                    # chunks only return once their files are on disk
+                    if journal is not None:
+                        journal.add(gene_id)
+                    if manifest is not None and gene_id in store:
+                        manifest.record(store, gene_id, output_basename(store, gene_id), params)
+                if done % progress_every == 0 or done == total:
+                    elapsed = time.perf_counter() - start
+                    print(f"{done}/{total} genes, {done / elapsed:.1f} genes/s, {len(failed)} failed")
+
+    if journal is not None:
+        journal.close()
+    if manifest is not None:
+        manifest.save()
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the single-gene TPM boxplots for many genes in parallel.')
+    parser.add_argument('tpm_file')
+    parser.add_argument('pval_file')
+    parser.add_argument('--genes', nargs='+', help='gene IDs to plot (default: all IDs in the p-value table)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: all cores)')
+    parser.add_argument('--chunksize', type=int, default=4, help='genes per task, their files are written while the next gene is drawn')
+    parser.add_argument('--formats', nargs='+', default=list(FORMATS), choices=FORMATS, help='output formats (default: pdf png svg)')
+    parser.add_argument('--backend', choices=['seaborn', 'matplotlib'], default='seaborn', help='matplotlib draws the same plot without seaborn, faster per gene')
+    parser.add_argument('--manifest', help='render manifest (e.g. boxplot-manifest.json), genes with up-to-date plots are skipped')
+    parser.add_argument('--checkpoint', metavar='JOURNAL', help='record finished genes in JOURNAL (e.g. boxplot-checkpoint.txt) and skip them when the run is restarted')
+    parser.add_argument('--design', help='conditions, replicate columns, colors and comparisons as JSON (default: mock/avian/swine/reass)')
+    parser.add_argument('--mmap', action='store_true', help='share one memory-mapped copy of the tables between all workers (kept in .table-cache)')
+    parser.add_argument('--max-rss-mb', type=float, default=None, help='per-worker memory ceiling, the figure is rebuilt when it is exceeded')
+    parser.add_argument('--profile', metavar='TRACE', help='write per-stage timings and memory deltas of every gene to TRACE (JSON lines) and print a summary')
+    args = parser.parse_args()
+
+    if args.profile:
+        stage_profiler.enable(args.profile)
+
+    failed = render_all_genes(args.tpm_file, args.pval_file, args.genes, args.workers, args.chunksize, max_rss_mb=args.max_rss_mb, formats=args.formats, manifest_file=args.manifest, backend=args.backend,
+                              design=Design.from_json(args.design) if args.design else None, mapped=args.mmap, checkpoint_file=args.checkpoint)
+    if args.profile:
+        stage_profiler.report()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,70 @@
+import argparse
+import time
+import warnings
+
+import matplotlib
+matplotlib.use('Agg')
+import numpy as np
+
+from expression_store import ExpressionStore
+from gene_stats import GeneStats
+from tpm_boxplot import BoxplotTemplate
+
+# Compare the seaborn and the plain matplotlib backend of the single-gene boxplot:
+# per-gene draw time and how many pixels differ between the two renderings.
+#
+# python scripts/benchmark-boxplot-backends.py input-data/tpms-human.tsv input-data/pvals-virus-comparisons.tsv --n 200
+
+BACKENDS = ['seaborn', 'matplotlib']
+
+
+def render_rgba(template, store, gene_id, stats, backend, seed):
+    # Same seed for both backends, so the stripplot jitter lands on the same spots
+    np.random.seed(seed)
+    start = time.perf_counter()
+    template.draw(store, gene_id, stats, backend)
+    template.fig.canvas.draw()
+    elapsed = time.perf_counter() - start
+    return np.asarray(template.fig.canvas.buffer_rgba()).copy(), elapsed
+
+
+def compare_backends(store, gene_ids, threshold=32):
+    stats = GeneStats.from_store(store, gene_ids)
+    templates = {backend: BoxplotTemplate(design=store.design) for backend in BACKENDS}
+    times = {backend: [] for backend in BACKENDS}
+    diffs = []
+    for seed, gene_id in enumerate(gene_ids):
+        images = {}
+        for backend in BACKENDS:
+            images[backend], elapsed = render_rgba(templates[backend], store, gene_id, stats, backend, seed)
+            times[backend].append(elapsed)
+        delta = np.abs(images['seaborn'].astype(np.int16) - images['matplotlib'].astype(np.int16)).max(axis=2)
+        diffs.append((delta > threshold).mean())
+    return times, np.array(diffs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark and visually diff the seaborn and matplotlib boxplot backends.')
+    parser.add_argument('tpm_file')
+    parser.add_argument('pval_file')
+    parser.add_argument('--genes', nargs='+', help='gene IDs (default: the first --n genes of the p-value table)')
+    parser.add_argument('--n', type=int, default=100)
+    parser.add_argument('--tolerance', type=float, default=0.001, help='max. fraction of differing pixels per plot')
+    args = parser.parse_args()
+
+    warnings.simplefilter('ignore')  # seaborn's palette deprecation warning, once per gene
+    store = ExpressionStore.from_files(args.tpm_file, args.pval_file)
+    gene_ids = args.genes or store.gene_ids()[:args.n]
+    gene_ids = [gene_id for gene_id in gene_ids if gene_id in store]
+
+    times, diffs = compare_backends(store, gene_ids)
+    for backend in BACKENDS:
+        ms = np.array(times[backend]) * 1000
+        print(f"{backend:>10}: {np.median(ms):6.1f} ms/gene median, {ms.mean():6.1f} mean, {ms.max():6.1f} max")
+    speedup = np.median(times['seaborn']) / np.median(times['matplotlib'])
+    print(f"speedup {speedup:.1f}x over {len(gene_ids)} genes")
+
+    worst = int(diffs.argmax())
+    print(f"differing pixels: {diffs.mean():.4%} mean, {diffs.max():.4%} max ({gene_ids[worst]})")
+    if diffs.max() > args.tolerance:
+        raise SystemExit(f"Visual diff above tolerance ({args.tolerance:.4%})")
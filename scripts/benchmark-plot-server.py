@@ -0,0 +1,106 @@
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from plot_server import PlotService, add_server_args, make_server
+
+# Load test of the plot server: concurrent clients request single-gene plots (and some panels) of a fixed set of
+# genes, so the first round mostly renders and later rounds come from the cache. Reports requests per second
+# and latency, overall and split by cache hit/miss.
+#
+# python scripts/benchmark-plot-server.py input-data/tpms-human.tsv input-data/pvals-virus-comparisons.tsv --genes 50 --requests 1000 --clients 16
+# or against a running server: --url http://127.0.0.1:8765 (the gene IDs are still read from the tables)
+
+
+def fetch(url, body=None):
+    # -> (status, cache status, seconds)
+    start = time.perf_counter()
+    data = json.dumps(body).encode() if body is not None else None
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'} if data else {})
+    try:
+        with urllib.request.urlopen(request, timeout=300) as response:
+            response.read()
+            return response.status, response.headers.get('X-Cache', ''), time.perf_counter() - start
+    except urllib.error.HTTPError as e:
+        e.read()
+        return e.code, '', time.perf_counter() - start
+
+
+def request_mix(gene_ids, n_requests, panel_share=0.0, fmt='png', dpi=100, seed=0):
+    # (path, body) pairs: random genes from the set, a share of them 4-gene panels
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(n_requests):
+        if rng.random() < panel_share:
+            requests.append(('/panel', {'genes': rng.sample(gene_ids, min(4, len(gene_ids))), 'format': fmt, 'dpi': dpi, 'ncols': 2}))
+        else:
+            requests.append((f'/gene/{rng.choice(gene_ids)}?format={fmt}&dpi={dpi}', None))
+    return requests
+
+
+def load_test(base_url, requests, clients):
+    results = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        results = list(pool.map(lambda request: fetch(base_url + request[0], request[1]), requests))
+    return results, time.perf_counter() - start
+
+
+def print_results(results, elapsed):
+    def line(label, rows):
+        if not rows:
+            return
+        seconds = np.array([row[2] for row in rows]) * 1000
+        print(f"{label:<6}{len(rows):>7}  p50 {np.percentile(seconds, 50):8.1f} ms  p95 {np.percentile(seconds, 95):8.1f} ms  max {seconds.max():8.1f} ms")
+
+    errors = [row for row in results if row[0] != 200]
+    print(f"{len(results)} requests in {elapsed:.2f} s: {len(results) / elapsed:.1f} requests/s, {len(errors)} errors")
+    line('all', results)
+    line('miss', [row for row in results if row[1] == 'miss'])
+    line('hit', [row for row in results if row[1] == 'hit'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Requests per second and latency of the local plot server.')
+    parser.add_argument('tpm_file')
+    parser.add_argument('pval_file')
+    parser.add_argument('--url', help='running server to test (default: start one in this process on a free port)')
+    parser.add_argument('--genes', type=int, default=50, help='number of distinct genes requested (the first N of the p-value table)')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--clients', type=int, default=8, help='concurrent client connections')
+    parser.add_argument('--panel-share', type=float, default=0.1, help='fraction of POST /panel requests')
+    parser.add_argument('--format', choices=['png', 'svg'], default='png')
+    parser.add_argument('--dpi', type=int, default=100)
+    add_server_args(parser)
+    args = parser.parse_args()
+
+    server = None
+    if args.url:
+        from expression_store import ExpressionStore
+        gene_ids = ExpressionStore.from_files(args.tpm_file, args.pval_file).gene_ids()[:args.genes]
+        base_url = args.url.rstrip('/')
+    else:
+        service = PlotService.from_files(args.tpm_file, args.pval_file, args.workers, args.cache_mb, mapped=args.mmap, backend=args.backend)
+        gene_ids = service.store.gene_ids()[:args.genes]
+        server = make_server(service, args.host, 0, quiet=not args.verbose)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://{args.host}:{server.server_address[1]}'
+        print(f"Server on {base_url} with {service.workers} worker(s), {args.cache_mb:.0f} MB cache")
+        # waits until a worker has loaded the tables, not part of the measurement
+        fetch(f'{base_url}/gene/{gene_ids[0]}?format={args.format}&dpi={args.dpi}')
+
+    results, elapsed = load_test(base_url, request_mix(gene_ids, args.requests, args.panel_share, args.format, args.dpi), args.clients)
+    print_results(results, elapsed)
+    with urllib.request.urlopen(f'{base_url}/stats') as response:
+        print(f"cache: {json.loads(response.read())['cache']}")
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        service.close()
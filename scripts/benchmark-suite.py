@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+
+from synthetic_data import write_tables
+
+# Times table loading, the single-gene and combined plots and batch mode on synthetic tables,
+# with the peak RSS of each step. Every benchmark runs in its own process, so peak RSS is per step.
+#
+# python scripts/benchmark-suite.py --genes 60000 --save benchmark-baseline.json
+# python scripts/benchmark-suite.py --genes 60000 --baseline benchmark-baseline.json   (after a change)
+#
+# Tables with more than the four mock/avian/swine/reass conditions are plotted with all their conditions
+# (Design.from_columns), so larger designs also show up in the plot timings.
+
+BENCHMARKS = ['load_parse', 'load_cached', 'precompute', 'plot_tpm_boxplot', 'template_render', 'plot_combined_boxplot', 'summary_grid', 'batch_render', 'template_rss']
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def _design(tpm_file):
+    # None (paper order and colors) unless the table has conditions beyond the four real ones
+    import pandas as pd
+    from design import Design, default_design
+    design = Design.from_columns(pd.read_csv(tpm_file, sep="\t", nrows=0).columns)
+    return None if set(design.keys) <= set(default_design.keys) else design
+
+
+def _load(tpm_file, pval_file):
+    from expression_store import ExpressionStore
+    return ExpressionStore.from_files(tpm_file, pval_file, design=_design(tpm_file))
+
+
+def bench_load_parse(tpm_file, pval_file, opts):
+    from expression_store import ExpressionStore
+    design = _design(tpm_file)
+    start = time.perf_counter()
+    store = ExpressionStore.from_files(tpm_file, pval_file, cache=False, design=design)
+    return time.perf_counter() - start, len(store.tpm)
+
+
+def bench_load_cached(tpm_file, pval_file, opts):
+    # The runner builds the cache in a warm-up run first
+    start = time.perf_counter()
+    store = _load(tpm_file, pval_file)
+    return time.perf_counter() - start, len(store.tpm)
+
+
+def bench_precompute(tpm_file, pval_file, opts):
+    from gene_stats import GeneStats
+    store = _load(tpm_file, pval_file)
+    start = time.perf_counter()
+    GeneStats.from_store(store)
+    store.significance().categories
+    return time.perf_counter() - start, len(store.tpm)
+
+
+def bench_plot_tpm_boxplot(tpm_file, pval_file, opts):
+    from tpm_boxplot import plot_tpm_boxplot
+    store = _load(tpm_file, pval_file)
+    gene_ids = store.gene_ids()[:opts.render_genes]
+    start = time.perf_counter()
+    for gene_id in gene_ids:
+        plot_tpm_boxplot(store, gene_id, formats=opts.formats, backend=opts.backend)
+    return time.perf_counter() - start, len(gene_ids)
+
+
+def bench_template_render(tpm_file, pval_file, opts):
+    from figure_export import FigureExporter
+    from gene_stats import GeneStats
+    from tpm_boxplot import BoxplotTemplate
+    store = _load(tpm_file, pval_file)
+    gene_ids = store.gene_ids()[:opts.render_genes]
+    stats = GeneStats.from_store(store, gene_ids)
+    template = BoxplotTemplate(design=store.design)
+    start = time.perf_counter()
+    with FigureExporter(opts.formats) as exporter:
+        for gene_id in gene_ids:
+            template.render(store, gene_id, exporter=exporter, stats=stats, backend=opts.backend)
+    return time.perf_counter() - start, len(gene_ids)
+
+
+def bench_plot_combined_boxplot(tpm_file, pval_file, opts):
+    import matplotlib.pyplot as plt
+    from gene_stats import long_form
+    from summary_boxplot import plot_combined_boxplot
+    store = _load(tpm_file, pval_file)
+    gene_ids = store.gene_ids()[:opts.summary_genes]
+    start = time.perf_counter()
+    all_data_df = long_form(store, gene_ids)
+    pvals_dict = {store.gene_name(gene_id): store.significance().row(gene_id) for gene_id in gene_ids}
+    plot_combined_boxplot(all_data_df, pvals_dict, 'benchmark_summary', opts.formats, store.design)
+    plt.close('all')
+    return time.perf_counter() - start, len(gene_ids)
+
+
+def bench_summary_grid(tpm_file, pval_file, opts):
+    from summary_grid import render_grid_pages
+    store = _load(tpm_file, pval_file)
+    gene_ids = store.gene_ids()[:opts.grid_genes]
+    start = time.perf_counter()
+    render_grid_pages(store, gene_ids, 'benchmark_grid', formats=[fmt for fmt in opts.formats if fmt != 'svg'])
+    return time.perf_counter() - start, len(gene_ids)
+
+
+def bench_batch_render(tpm_file, pval_file, opts):
+    from batch_render import read_gene_ids, render_all_genes
+    gene_ids = read_gene_ids(pval_file)[:opts.batch_genes]
+    design = _design(tpm_file)
+    start = time.perf_counter()
+    failed = render_all_genes(tpm_file, pval_file, gene_ids, opts.workers, formats=opts.formats, backend=opts.backend, design=design)
+    if failed:
+        raise RuntimeError(f"{len(failed)} genes failed")
+    return time.perf_counter() - start, len(gene_ids)
+
+
+def bench_template_rss(tpm_file, pval_file, opts):
+    # Memory check of the reused figure: draw many genes and compare RSS after a warm-up with RSS at the end.
+    # Drawing without writing files keeps it to the figure itself. The template's max_rss_mb ceiling is checked
+    # after every gene as in render(), going over it fails the run (and the suite exits non-zero).
+    from gene_stats import GeneStats
+    from tpm_boxplot import BoxplotTemplate, current_rss_mb
+    store = _load(tpm_file, pval_file)
+    gene_ids = store.gene_ids()
+    gene_ids = (gene_ids * (opts.rss_genes // max(len(gene_ids), 1) + 1))[:opts.rss_genes]
+    stats = GeneStats.from_store(store, list(dict.fromkeys(gene_ids)))
+    template = BoxplotTemplate(max_rss_mb=opts.max_rss_mb, design=store.design)
+    warmup = min(100, len(gene_ids) // 10)
+    start = time.perf_counter()
+    for i, gene_id in enumerate(gene_ids):
+        if i == warmup:
+            rss_start = current_rss_mb()
+        template.draw(store, gene_id, stats, opts.backend)
+        template.fig.canvas.draw()
+        template.check_rss(gene_id)
+    growth = current_rss_mb() - rss_start
+    print(f"RSS growth over {len(gene_ids) - warmup} genes after warm-up: {growth:.1f} MB")
+    if growth > opts.rss_growth_mb:
+        raise RuntimeError(f"RSS grew by {growth:.1f} MB, more than {opts.rss_growth_mb} MB")
+    return time.perf_counter() - start, len(gene_ids), {'rss_growth_mb': growth, 'max_rss_mb': opts.max_rss_mb}
+
+
+def run_child(name, tpm_file, pval_file, opts):
+    import matplotlib
+    matplotlib.use('Agg')
+    warnings.simplefilter('ignore')
+    # Each benchmark returns (seconds, items) and optionally a dict of extra measurements
+    seconds, items, *extra = globals()[f'bench_{name}'](tpm_file, pval_file, opts)
+    result = {
+        'seconds': seconds,
+        'items': items,
+        'ms_per_item': seconds / items * 1000 if items else None,
+        'peak_rss_mb': max(_peak_rss_mb(), _peak_rss_mb(resource.RUSAGE_CHILDREN)),
+    }
+    for measurements in extra:
+        result.update(measurements)
+    return result
+
+
+def run_benchmark(name, tpm_file, pval_file, argv, workdir):
+    # Fresh interpreter per benchmark, output files go to workdir
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', name, '--tables', tpm_file, pval_file] + argv
+    proc = subprocess.run(cmd, cwd=workdir, capture_output=True, text=True)
+    for line in reversed(proc.stdout.splitlines()):
+        if line.startswith('RESULT '):
+            return json.loads(line[len('RESULT '):])
+    return {'error': (proc.stderr or proc.stdout).strip().splitlines()[-1] if (proc.stderr or proc.stdout).strip() else f'exit code {proc.returncode}'}
+
+
+def compare(results, baseline, threshold):
+    # Regressions: wall time or peak RSS more than threshold above the baseline
+    regressions = []
+    print(f"\n{'benchmark':<22}{'seconds':>10}{'baseline':>10}{'change':>9}{'RSS MB':>10}{'baseline':>10}{'change':>9}")
+    for name, result in results.items():
+        base = baseline.get('results', {}).get(name)
+        if base is None or 'error' in result or 'error' in base:
+            continue
+        row = f"{name:<22}"
+        for metric in ('seconds', 'peak_rss_mb'):
+            change = result[metric] / base[metric] - 1 if base[metric] else 0.0
+            row += f"{result[metric]:>10.2f}{base[metric]:>10.2f}{change:>+9.0%}"
+            if change > threshold:
+                regressions.append(f"{name} {metric}: {base[metric]:.2f} -> {result[metric]:.2f} ({change:+.0%})")
+        print(row)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark loading, plotting and batch rendering on synthetic tables.')
+    parser.add_argument('benchmarks', nargs='*', help=f"benchmarks to run (default: all; choices: {', '.join(BENCHMARKS)})")
+    parser.add_argument('--genes', type=int, default=20000, help='genes in the synthetic tables (1k-250k)')
+    parser.add_argument('--conditions', type=int, default=4, help='conditions in the synthetic tables (4-20)')
+    parser.add_argument('--reps', type=int, default=3, help='replicates per condition (3-10)')
+    parser.add_argument('--data-dir', default='benchmark-data', help='where synthetic tables are written and reused')
+    parser.add_argument('--tables', nargs=2, metavar=('TPM_FILE', 'PVAL_FILE'), help='benchmark these tables instead of synthetic ones')
+    parser.add_argument('--formats', nargs='+', default=['pdf', 'png', 'svg'], choices=['pdf', 'png', 'svg'])
+    parser.add_argument('--backend', choices=['seaborn', 'matplotlib'], default='seaborn')
+    parser.add_argument('--render-genes', type=int, default=20, help='genes for the single-gene plot benchmarks')
+    parser.add_argument('--summary-genes', type=int, default=5, help='genes in the combined boxplot')
+    parser.add_argument('--grid-genes', type=int, default=48, help='genes for the paged grid')
+    parser.add_argument('--batch-genes', type=int, default=200, help='genes for batch mode')
+    parser.add_argument('--workers', type=int, default=2, help='worker processes for batch mode')
+    parser.add_argument('--rss-genes', type=int, default=5000, help='genes drawn by template_rss')
+    parser.add_argument('--rss-growth-mb', type=float, default=20, help='allowed RSS growth in template_rss')
+    parser.add_argument('--max-rss-mb', type=float, default=1024, help='RSS ceiling of the BoxplotTemplate in template_rss')
+    parser.add_argument('--save', help='write the results as JSON (e.g. a new baseline)')
+    parser.add_argument('--baseline', help='JSON of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown/memory increase reported as regression')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print('RESULT ' + json.dumps(run_child(args.child, *args.tables, args)))
+        sys.exit(0)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+    names = args.benchmarks or BENCHMARKS
+
+    if args.tables:
+        tpm_file, pval_file = (os.path.abspath(path) for path in args.tables)
+    else:
+        start = time.perf_counter()
+        tpm_file, pval_file = (os.path.abspath(path) for path in write_tables(args.data_dir, args.genes, args.conditions, args.reps))
+        print(f"Tables: {tpm_file} ({time.perf_counter() - start:.1f} s)")
+
+    # Options passed on to every child run
+    argv = ['--formats', *args.formats, '--backend', args.backend,
+            '--render-genes', str(args.render_genes), '--summary-genes', str(args.summary_genes),
+            '--grid-genes', str(args.grid_genes), '--batch-genes', str(args.batch_genes), '--workers', str(args.workers),
+            '--rss-genes', str(args.rss_genes), '--rss-growth-mb', str(args.rss_growth_mb), '--max-rss-mb', str(args.max_rss_mb)]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as workdir:
+        if 'load_cached' in names:
+            run_benchmark('load_cached', tpm_file, pval_file, argv, workdir)  # builds the table cache
+        for name in names:
+            result = run_benchmark(name, tpm_file, pval_file, argv, workdir)
+            results[name] = result
+            if 'error' in result:
+                print(f"{name:<22} FAILED: {result['error']}")
+            else:
+                print(f"{name:<22} {result['seconds']:8.2f} s  {result['ms_per_item']:9.2f} ms/item  {result['peak_rss_mb']:8.0f} MB peak RSS")
+
+    report = {
+        'meta': {
+            'tables': [tpm_file, pval_file],
+            # Shape of the synthetic tables, None when --tables was given
+            'genes': None if args.tables else args.genes,
+            'conditions': None if args.tables else args.conditions,
+            'reps': None if args.tables else args.reps,
+            'formats': args.formats, 'backend': args.backend, 'workers': args.workers,
+            'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w') as fh:
+            json.dump(report, fh, indent=1)
+
+    failed = [name for name, result in results.items() if 'error' in result]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if {key: baseline['meta'].get(key) for key in ('genes', 'conditions', 'reps', 'formats', 'backend')} != {key: report['meta'][key] for key in ('genes', 'conditions', 'reps', 'formats', 'backend')}:
+            print("Warning: baseline was run with different tables or settings")
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    sys.exit(1 if failed or regressions else 0)
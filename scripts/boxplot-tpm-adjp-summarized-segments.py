@@ -2,59 +2,15 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import math
+from design import default_design
+from expression_store import ExpressionStore
+from figure_export import RASTER_DPI, print_file_reports, rasterize_dense_layers, save_figure, show
+from gene_stats import long_form
 
-def get_significance_stars(pval):
-    if pval <= 0.001:
-        return '***'
-    elif pval <= 0.01:
-        return '**'
-    elif pval <= 0.05:
-        return '*'
-    else:
-        return None
-
-def plot_tpm_boxplot(tpm_file, pval_file, gene_id, collect_data=False):
-    df = pd.read_csv(tpm_file, sep="\t")
-    pvals = pd.read_csv(pval_file, sep="\t")
-
-    if gene_id not in df['ID'].values or gene_id not in pvals['ID'].values:
-        print(f"Gene ID '{gene_id}' not found.")
-        return
-
-    gene_data = df[df['ID'] == gene_id]
-    pval_data = pvals[pvals['ID'] == gene_id]
-
-    gene_name = gene_data['Name'].values[0] if 'Name' in gene_data.columns else gene_id
-    if pd.isna(gene_name) or gene_name.strip() == "":
-        gene_name = gene_id
-    safe_name = gene_name.replace(" ", "_").replace("/", "_")
-    filename_base = f'{safe_name}_{gene_id}'
-
-    data = {
-        'Mock': gene_data[['mock-rep1', 'mock-rep2', 'mock-rep3']].values.flatten(),
-        'Avian': gene_data[['avian-rep1', 'avian-rep2', 'avian-rep3']].values.flatten(),
-        'Swine': gene_data[['swine-rep1', 'swine-rep2', 'swine-rep3']].values.flatten(),
-        'Reassortant': gene_data[['reass-rep1', 'reass-rep2', 'reass-rep3']].values.flatten()
-    }
-
-    plot_df = pd.DataFrame([
-        {'Virus': cond, 'TPM': tpm}
-        for cond, values in data.items()
-        for tpm in values
-    ])
-
-    if collect_data:
-        plot_df['Gene'] = gene_name
-        plot_df['GeneID'] = gene_id
-        return plot_df, pval_data, gene_name
-
-def plot_combined_boxplot(all_data_df, pvals_dict):
-    custom_palette = {
-        'Mock': (1.0, 1.0, 1.0, 1.0),
-        'Reassortant': (0.6078, 0.7451, 0.9608, 1.0),
-        'Avian': (0.9490, 0.6392, 0.6392, 1.0),
-        'Swine': (0.7137, 0.9804, 0.6784, 1.0)
-    }
+def plot_combined_boxplot(all_data_df, pvals_dict, rasterize=None, raster_dpi=RASTER_DPI, report=False):
+    # rasterize ('auto', 'points' or 'all', see figure_export.rasterize_dense_layers): layers as images at raster_dpi in PDF/SVG,
+    # without it the figure is unchanged. report=True prints size and write time of every file.
+    custom_palette = default_design.palette
 
     # filer Mock values - always 0 anyway
     all_data_df = all_data_df[all_data_df['Virus'] != 'Mock']
@@ -80,7 +36,7 @@ def plot_combined_boxplot(all_data_df, pvals_dict):
     all_data_df['Gene'] = pd.Categorical(all_data_df['Gene'], categories=gene_order, ordered=True)
 
     # Set desired order for viruses
-    virus_order = ['Avian', 'Swine', 'Reassortant']
+    virus_order = default_design.without('Mock').labels
     all_data_df['Virus'] = pd.Categorical(all_data_df['Virus'], categories=virus_order, ordered=True)
 
     all_data_df = all_data_df.sort_values(by=['Gene', 'Virus'])
@@ -97,6 +53,8 @@ def plot_combined_boxplot(all_data_df, pvals_dict):
         dodge=False,
         ax=ax
     )
+    if rasterize:
+        rasterize_dense_layers(ax, rasterize)
 
     # Remove Virus names for plotting to save space
     ax.set_xticklabels(all_data_df['Gene'].unique(), rotation=45, ha='right')
@@ -125,34 +83,13 @@ def plot_combined_boxplot(all_data_df, pvals_dict):
     # p-value annotations
     offset_counter = 0
     bar_height_factor = 0.85
-    virus_order = ['Mock', 'Avian', 'Swine', 'Reassortant']
 
     virus_gene_labels = all_data_df['Virus_Gene'].unique().tolist()
     label_to_pos = {label: i for i, label in enumerate(virus_gene_labels)}
 
     for gene, pval_data in pvals_dict.items():
-        for col in pval_data.columns:
-            if col == 'ID':
-                continue
-            try:
-                cond1_raw, cond2_raw = col.split("-")
-                cond1 = cond1_raw.capitalize()
-                cond2 = cond2_raw.capitalize()
-                if cond1.startswith('Reass'):
-                    cond1 = 'Reassortant'
-                if cond2.startswith('Reass'):
-                    cond2 = 'Reassortant'
-            except:
-                continue
-
-            if cond1 not in virus_order or cond2 not in virus_order:
-                continue
-
-            pval = pval_data.iloc[0][col]
-            stars = get_significance_stars(pval)
-            if stars is None:
-                continue
-
+        # only the significant comparisons, parsed and classified once for the whole p-value table
+        for cond1, cond2, _, _, _, stars in pval_data:
             label1 = f"{gene}\n{cond1}"
             label2 = f"{gene}\n{cond2}"
 
@@ -171,10 +108,12 @@ def plot_combined_boxplot(all_data_df, pvals_dict):
             offset_counter += 1
 
     plt.tight_layout()
-    plt.savefig('combined_summary_boxplot_with_pvalues_segments.pdf')
-    plt.savefig('combined_summary_boxplot_with_pvalues_segments.png', dpi=300)
-    plt.savefig('combined_summary_boxplot_with_pvalues_segments.svg')
-    plt.show()
+    # each file through a temporary name, a crash never leaves a partial plot
+    reports = [save_figure(plt.gcf(), f'combined_summary_boxplot_with_pvalues_segments.{fmt}', fmt, raster_dpi=raster_dpi if rasterize else None)
+               for fmt in ('pdf', 'png', 'svg')]
+    if report:
+        print_file_reports(reports)
+    show()  # returns right away with RNASEQ_BATCH=1 or without a display
 
 # === MAIN execution ===
 
@@ -187,18 +126,27 @@ gene_ids = [
     'gene-vRNA-HA', 'gene-vRNA-MP', 'gene-vRNA-NA', 'gene-vRNA-NP',
     'gene-vRNA-NS1', 'gene-vRNA-PA', 'gene-vRNA-PB1', 'gene-vRNA-PB2']
 
-all_data = []
-pvals_dict = {}
+# load both tables once, genes are looked up by ID
+store = ExpressionStore.from_files(tpm_file, pval_file)
+# or the memory-mapped copy in .table-cache, shared with batch_render.py --mmap workers reading the same files
+#from mapped_store import MappedStore
+#store = MappedStore.from_files(tpm_file, pval_file)
+# or straight from the per-sample featureCounts files (see segment_counts.py), NS1 -> NS etc. also renames the p-value IDs
+#from segment_counts import segment_store, SEGMENT_RENAMES
+#store = segment_store('/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/segments-strand2-vRNAmRNA', pval_file)
+#store = segment_store('/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/segments-strand2-vRNAmRNA', pval_file, renames=SEGMENT_RENAMES)  # then gene-mRNA-NS etc. in gene_ids
 
-for gene_id in gene_ids:
-    result = plot_tpm_boxplot(tpm_file, pval_file, gene_id, collect_data=True)
-    if result:
-        gene_data_df, pval_data, gene_name = result
-        all_data.append(gene_data_df)
-        pvals_dict[gene_name] = pval_data
+# long-form Gene/GeneID/Virus/TPM table for all genes at once
+all_data_df = long_form(store, gene_ids)
+pvals_dict = {store.gene_name(gene_id): store.significance().row(gene_id) for gene_id in gene_ids if gene_id in store}
 
-all_data_df = pd.concat(all_data, ignore_index=True)
 plot_combined_boxplot(all_data_df, pvals_dict)
+# smaller PDF/SVG: stripplot points (or with 'all' also the boxes) as images, text and brackets stay vectors
+#plot_combined_boxplot(all_data_df, pvals_dict, rasterize='points', raster_dpi=300, report=True)
+
+# for more than ~10 genes: pages of small per-gene boxplots (N genes per page) instead of one very wide figure
+#from summary_grid import render_grid_pages
+#render_grid_pages(store, gene_ids, 'combined_summary_boxplot_grid_segments', genes_per_page=12, design=default_design.without('Mock'), sharey=True)
 
 
 
@@ -2,148 +2,11 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import sys
-
-def get_significance_stars(pval):
-    if pval <= 0.001:
-        return '***'
-    elif pval <= 0.01:
-        return '**'
-    elif pval <= 0.05:
-        return '*'
-    else:
-        return None  # Skip non-significant
-
-def plot_tpm_boxplot(tpm_file, pval_file, gene_id):
-    # Load TPM and p-value data
-    df = pd.read_csv(tpm_file, sep="\t")
-    pvals = pd.read_csv(pval_file, sep="\t")
-
-    if gene_id not in df['ID'].values or gene_id not in pvals['ID'].values:
-        print(f"Gene ID '{gene_id}' not found in one of the tables.")
-        return
-
-    gene_data = df[df['ID'] == gene_id]
-    pval_data = pvals[pvals['ID'] == gene_id]
-
-    # Get gene name or fallback to ID
-    gene_name = gene_data['Name'].values[0] if 'Name' in gene_data.columns else gene_id
-    if pd.isna(gene_name) or gene_name.strip() == "":
-        gene_name = gene_id
-    safe_name = gene_name.replace(" ", "_").replace("/", "_")
-    filename_base = f'{safe_name}_{gene_id}'
-
-    # TPM values per condition
-    data = {
-        'Mock': gene_data[['mock-rep1', 'mock-rep2', 'mock-rep3']].values.flatten(),
-        'Avian': gene_data[['avian-rep1', 'avian-rep2', 'avian-rep3']].values.flatten(),
-        'Swine': gene_data[['swine-rep1', 'swine-rep2', 'swine-rep3']].values.flatten(),
-        'Reassortant': gene_data[['reass-rep1', 'reass-rep2', 'reass-rep3']].values.flatten()
-    }
-
-    # Prepare data for plotting
-    plot_df = pd.DataFrame([
-        {'Virus': cond, 'TPM': tpm}
-        for cond, values in data.items()
-        for tpm in values
-    ])
-
-    # Define color palette
-    custom_palette = {
-        'Mock': (1.0, 1.0, 1.0, 1.0),              # white
-        'Reassortant': (0.6078, 0.7451, 0.9608, 1.0),  # blue
-        'Avian': (0.9490, 0.6392, 0.6392, 1.0),       # red
-        'Swine': (0.7137, 0.9804, 0.6784, 1.0)        # green
-    }
-
-    plt.figure(figsize=(4, 4))
-    sns.boxplot(x='Virus', y='TPM', data=plot_df, palette=custom_palette, order=['Mock', 'Avian', 'Swine', 'Reassortant'])
-    sns.stripplot(x='Virus', y='TPM', data=plot_df, color='black', size=5, jitter=True, order=['Mock', 'Avian', 'Swine', 'Reassortant'])
-
-    # Check for log scale
-    y_max = plot_df['TPM'].max()
-    y_min = plot_df['TPM'].min()
-    use_log_scale = y_max / max(y_min, 0.1) > 100
-
-    if use_log_scale:
-        plt.yscale('log')
-        plt.ylabel('Expression level (TPM, log scale)')
-    else:
-        plt.ylabel('Expression level (TPM)')
-
-    # Title: Gene name and ID
-    plt.title(f'{gene_name} ({gene_id})')
-
-    # Dynamic p-value annotation
-    positions = {'Mock': 0, 'Avian': 1, 'Swine': 2, 'Reassortant': 3}
-    cond_names = list(positions.keys())
-
-    offset_counter = 0
-    log_y_positions = []
-
-    if use_log_scale:
-        base_height = y_max * 1.5
-    else:
-        y_range = y_max - y_min
-        base_height = y_max + 0.05 * y_range
-
-    for col in pval_data.columns:
-        if col == "ID":
-            continue
-
-        try:
-            cond1_raw, cond2_raw = col.split("-")
-            cond1 = cond1_raw.capitalize()
-            cond2 = cond2_raw.capitalize()
-
-            # Fix capitalization manually if needed
-            cond1 = "Reassortant" if cond1.startswith("Reass") else cond1
-            cond2 = "Reassortant" if cond2.startswith("Reass") else cond2
-
-            if cond1 not in cond_names or cond2 not in cond_names:
-                continue
-
-        except Exception as e:
-            print(f"Skipping {col}: {e}")
-            continue
-
-        pval = pval_data.iloc[0][col]
-        stars = get_significance_stars(pval)
-        if stars is None:
-            continue  # Skip non-significant
-
-        x1, x2 = positions[cond1], positions[cond2]
-
-        if use_log_scale:
-            if not log_y_positions:
-                y = base_height
-            else:
-                y = log_y_positions[-1] * 2.2
-            log_y_positions.append(y)
-            bar_height = y * 0.15
-        else:
-            y = base_height + offset_counter * 0.12 * y_range
-            bar_height = 0.02 * y_range
-
-        text_label = f"p={pval:.2g} ({stars})"
-        plt.plot([x1, x1, x2, x2], [y, y + bar_height, y + bar_height, y], lw=1.2, c='black')
-        plt.text((x1 + x2) / 2, y + bar_height * 1.05, text_label, ha='center', va='bottom', fontsize=9)
-
-        offset_counter += 1
-
-    # Extend y-limits to fit all annotations
-    if use_log_scale and log_y_positions:
-        plt.ylim(y_min, log_y_positions[-1] * 2)
-    elif not use_log_scale:
-        current_ylim = plt.ylim()
-        plt.ylim(current_ylim[0], current_ylim[1] + 0.05 * y_range)
-
-    plt.tight_layout()
-
-    # Save outputs
-    plt.savefig(f'boxplot.{filename_base}.pdf')
-    plt.savefig(f'boxplot.{filename_base}.png', dpi=300)
-    plt.savefig(f'boxplot.{filename_base}.svg')
-    # plt.show()  # Uncomment if you want interactive plots
+from expression_store import ExpressionStore
+from tpm_boxplot import plot_tpm_boxplot
+from render_cache import RenderManifest
+from figure_export import FigureExporter, FigureWriteError
+import stage_profiler
 
 #############
 ## Human genes
@@ -152,6 +15,23 @@ tpm_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rna
 #pval_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/pvals-all-human-comparisons.tsv' # this is old, bc we use now all virus comparisons except vs mock
 pval_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/pvals-virus-comparisons.tsv'
 
+# per-stage timings of the run below (or set RNASEQ_PROFILE=trace.jsonl), summary printed at the end
+#stage_profiler.enable('boxplot-trace.jsonl')
+
+# load both tables once, all plot calls below look up genes by ID
+store = ExpressionStore.from_files(tpm_file, pval_file)
+# or the memory-mapped copy in .table-cache, shared with batch_render.py --mmap workers reading the same files
+#from mapped_store import MappedStore
+#store = MappedStore.from_files(tpm_file, pval_file)
+# remembers what was plotted, genes with unchanged data/settings and untouched output files are skipped on reruns
+manifest = RenderManifest('boxplot-manifest.json')
+# pdf/png/svg of each gene are written by background threads while the next gene is drawn
+exporter = FigureExporter()
+# or skip tpms-human.tsv and merge the per-condition *_reps_tpms.tsv files in memory (see combine_tpms.py)
+#from combine_tpms import combine_tpms
+#from expression_store import load_pval_table
+#store = ExpressionStore(combine_tpms('/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data'), load_pval_table(pval_file))
+
 #gene_id = 'ENSG00000225855'
 #gene_id = 'ENSG00000107201' # DDX58
 #gene_id = 'ENSG00000182393'	# IFNL1
@@ -165,15 +45,24 @@ pval_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rn
 # IFNL3 ENSG00000197110
 #gene_ids = ['ENSG00000105559', 'ENSG00000185885', 'ENSG00000197110', 'ENSG00000183709', 'ENSG00000182393']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 # additional gene for Fig3 replacing CASP3
 # IFNA5 ENSG00000147873
 gene_ids = ['ENSG00000147873']
 for gene_id in gene_ids:
-    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
-#plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
+
+# all genes in a run that can be killed and restarted (RNASEQ_BATCH=1 python scripts/boxplot-tpm-adjp.py on a node without
+# a display): a gene goes into the journal once all its files are on disk, a restart continues at the first gene without
+#from checkpoint import CheckpointJournal
+#from tpm_boxplot import render_params
+#checkpoint = CheckpointJournal('boxplot-checkpoint.txt', render_params(exporter.formats))
+#exporter.on_written = checkpoint.add
+#for gene_id in checkpoint.remaining(store.gene_ids()):
+#    plot_tpm_boxplot(store, gene_id, exporter=exporter)
 
 #TJP1    ENSG00000104067
 #OCLN    ENSG00000197822
@@ -189,7 +78,7 @@ for gene_id in gene_ids:
 
 #gene_ids = ['ENSG00000104067','ENSG00000197822','ENSG00000179776','ENSG00000164305','ENSG00000134333','ENSG00000111716','ENSG00000166796','ENSG00000166816','ENSG00000142089','ENSG00000055332','ENSG00000179242']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 
 ######### Genes for Supplement probably, downregulated in Reassortant
@@ -207,7 +96,7 @@ for gene_id in gene_ids:
 #gene_id = "ENSG00000168078"
 #gene_id = "ENSG00000205544"
 
-#plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 ########### Genes for Fig3 F panel
 
@@ -226,7 +115,12 @@ for gene_id in gene_ids:
 
 #gene_ids = ['ENSG00000119922', 'ENSG00000182393', 'ENSG00000271503', 'ENSG00000135114', 'ENSG00000173110', 'ENSG00000171855', 'ENSG00000157601']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
+
+# or the candidates straight from the DESeq2 tables, e.g. the 15 genes most up-regulated vs mock in all viruses (see gene_ranking.py)
+#from gene_ranking import GeneRanking, deseq2_paths
+#ranking = GeneRanking.from_deseq2(deseq2_paths('/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data'), store.gene_ids())
+#gene_ids = [gene.gene_id for gene in ranking.top(15, *ranking.criteria(down_in='mock'))]
 
 
 ############# Genes for Fig4 E panel
@@ -248,7 +142,7 @@ for gene_id in gene_ids:
 
 #gene_ids = ['ENSG00000119922', 'ENSG00000271503', 'ENSG00000135114', 'ENSG00000171855', 'ENSG00000173110', 'ENSG00000068097', 'ENSG00000105559', 'ENSG00000115415', 'ENSG00000170581', 'ENSG00000100906', 'ENSG00000108771', 'ENSG00000187608']
 #for gene_id in gene_ids:
-#   plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#   plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 ## UPDATE SELECTION
 #1) RIG-I: 
@@ -284,17 +178,14 @@ for gene_id in gene_ids:
 
 #gene_ids = ['ENSG00000177700', 'ENSG00000168404', 'ENSG00000165806', 'ENSG00000108771', 'ENSG00000185507', 'ENSG00000187608', 'ENSG00000100906', 'ENSG00000121060', 'ENSG00000185338', 'ENSG00000115415', 'ENSG00000170581', 'ENSG00000143384', 'ENSG00000125740', 'ENSG00000118503', 'ENSG00000169429', 'ENSG00000081041']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 
 ###############################################
-# PLOT ALL GENES (a bit buggy and a lot of files!)
-# Automatically extract all gene IDs from the pvals file
-#pvals_df = pd.read_csv(pval_file, sep="\t")
-#gene_ids = pvals_df['ID'].dropna().unique()
-
-#for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+# PLOT ALL GENES (a lot of files!)
+# Runs in parallel over a process pool, each worker loads the tables once. Use the batch script directly
+# instead of calling it from here, so the worker processes don't re-run this file:
+# python scripts/batch_render.py input-data/tpms-human.tsv input-data/pvals-virus-comparisons.tsv --workers 32
 
 
 
@@ -303,6 +194,7 @@ for gene_id in gene_ids:
 ## Influenza Segments - STRAND 2
 #tpm_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/counts-tpm-remove-HA-mock2-count1-segments.tsv'
 #pval_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/pvals-without-mock-segments.tsv'
+#store = ExpressionStore.from_files(tpm_file, pval_file)
 
 #gene_id = 'gene-PB2'
 #gene_id = 'gene-HA'
@@ -311,7 +203,7 @@ for gene_id in gene_ids:
 
 #gene_ids = ['gene-HA','gene-MP','gene-NA','gene-NP','gene-NS1','gene-PA','gene-PB1','gene-PB2']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 
 
@@ -319,6 +211,7 @@ for gene_id in gene_ids:
 ## Influenza Segments - STRAND 1
 #tpm_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/counts-tpm-remove-NP_mock1_and_PB1_mock3-count1-segments-strand1.tsv'
 #pval_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/pvals-without-mock-segments-strand1.tsv'
+#store = ExpressionStore.from_files(tpm_file, pval_file)
 
 #gene_id = 'gene-PB2'
 #gene_id = 'gene-HA'
@@ -327,13 +220,14 @@ for gene_id in gene_ids:
 
 #gene_ids = ['gene-HA','gene-MP','gene-NA','gene-NP','gene-NS1','gene-PA','gene-PB1','gene-PB2']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 
 ##############
 ## Influenza Segments - STRAND 1 BUT only DESeq2 results for segments! Still the same TPMs from RNAflow! 
 #tpm_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/counts-tpm-remove-NP_mock1_and_PB1_mock3-count1-segments-strand1.tsv'
 #pval_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/pvals-without-mock-segments-strand1-onlySegments.tsv'
+#store = ExpressionStore.from_files(tpm_file, pval_file)
 
 #gene_id = 'gene-PB2'
 #gene_id = 'gene-HA'
@@ -342,12 +236,13 @@ for gene_id in gene_ids:
 
 #gene_ids = ['gene-HA','gene-MP','gene-NA','gene-NP','gene-NS1','gene-PA','gene-PB1','gene-PB2']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
 
 ############## 2026-07-08
 ## Influenza Segments - STRAND 2 and rerun with annotation that includes mRNA and vRNAs 
 #tpm_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/counts-tpm-remove-mRNA-NP_mock1_and_mRNA-PB1_mock3_and_vRNA-HA_mock2-count1-segments-strand2-vRNAmRNA.tsv'
 #pval_file = '/Users/martin/projects/2025-03-13-Influenza-RNASeq-Agustina/2025-rnaseq-boxplots-for-paper/input-data/pvals-without-mock-segments-strand2-vRNAmRNA.tsv'
+#store = ExpressionStore.from_files(tpm_file, pval_file)
 
 #gene_id = 'gene-PB2'
 #gene_id = 'gene-HA'
@@ -360,9 +255,20 @@ for gene_id in gene_ids:
 #    'gene-vRNA-HA', 'gene-vRNA-MP', 'gene-vRNA-NA', 'gene-vRNA-NP',
 #    'gene-vRNA-NS1', 'gene-vRNA-PA', 'gene-vRNA-PB1', 'gene-vRNA-PB2']
 #for gene_id in gene_ids:
-#    plot_tpm_boxplot(tpm_file, pval_file, gene_id)
-
-
+#    plot_tpm_boxplot(store, gene_id, manifest=manifest, exporter=exporter)
+
+
+# all files on disk; genes whose files failed to write are dropped from the manifest (rendered again next run),
+# the rest is saved before raising with the gene ID of the first failed write
+errors = exporter.wait()
+for gene_id in errors:
+    manifest.discard(gene_id)
+manifest.save()
+exporter.close()
+stage_profiler.report()
+if errors:
+    gene_id, (path, error) = next(iter(errors.items()))
+    raise FigureWriteError(gene_id, path, error, len(errors)) from error
 
 # COLOR CODES
 
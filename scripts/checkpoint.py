@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import threading
+
+CHECKPOINT_FILE = 'boxplot-checkpoint.txt'
+_HEADER = '# rnaseq-boxplots checkpoint '
+
+
+def job_key(params):
+    # Hash of the render settings (formats, backend, design, see tpm_boxplot.render_params) the journal was written for
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class CheckpointJournal:
+    """Append-only journal of the gene IDs whose plots are completely on disk, to resume a killed run."""
+
+    def __init__(self, path=CHECKPOINT_FILE, params=None):
+        # One gene ID per line after a header with the job key. Every ID is appended and fsync'ed only after all
+        # files of the gene were renamed into place (see figure_export.atomic_output), so a crash loses at most
+        # the genes that were still being written. A torn last line is dropped when the journal is opened.
+        self.path = path
+        self.key = job_key(params or {})
+        self.done = set()
+        self._lock = threading.Lock()
+        lines, complete = self._read()
+        if lines and lines[0] == _HEADER + self.key:
+            self.done = set(lines[1:])
+            if not complete:
+                self._rewrite(lines[1:])
+        else:
+            if lines:
+                print(f"{path} was written for other plot settings, starting over")
+            self._rewrite([])
+        self._fh = open(path, 'a')
+
+    def _read(self):
+        # -> (complete lines, True if the file ended with a newline)
+        try:
+            with open(self.path) as fh:
+                text = fh.read()
+        except FileNotFoundError:
+            return [], True
+        lines = text.split('\n')
+        # the last element is '' after a final newline, otherwise a line cut off by the crash
+        return [line for line in lines[:-1] if line], text.endswith('\n') or not text
+
+    def _rewrite(self, gene_ids):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as fh:
+            fh.write(''.join(f'{line}\n' for line in [_HEADER + self.key, *gene_ids]))
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+
+    def __contains__(self, gene_id):
+        return gene_id in self.done
+
+    def __len__(self):
+        return len(self.done)
+
+    def remaining(self, gene_ids):
+        # Genes still to render, in the given order: the run resumes at the first incomplete gene
+        return [gene_id for gene_id in gene_ids if gene_id not in self.done]
+
+    def add(self, gene_id):
+        # Thread-safe, called from the exporter's writer threads
+        with self._lock:
+            if gene_id in self.done:
+                return
+            self._fh.write(f'{gene_id}\n')
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self.done.add(gene_id)
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,129 @@
+import argparse
+import glob
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from design import oriented_name
+from gene_lists import read_gene_list
+
+# DESeq2 result tables, one per comparison: deseq2_<condition>_vs_<condition>_full.csv (or *_full_extended.csv from RNAflow)
+PATTERN = 'deseq2_*_full*.csv'
+_NAME_RE = re.compile(r'deseq2_(?P<cond1>.+?)_vs_(?P<cond2>.+?)_full(?:_extended)?\.csv$')
+# Condition names in the file names -> column names of the p-value tables
+CONDITION_NAMES = {'mock': 'mock', 'avian': 'avian', 'swine': 'swine', 'reassortant': 'reass', 'reass': 'reass'}
+VALUE_COLUMNS = ['padj', 'pvalue', 'log2FoldChange']
+
+
+def comparison_conditions(path):
+    # deseq2_Avian_vs_Mock_full_extended.csv -> ('mock', 'avian', True): mock always first, True if that swapped the file's order
+    match = _NAME_RE.search(os.path.basename(path))
+    if match is None:
+        raise ValueError(f"{path}: expected deseq2_<condition>_vs_<condition>_full.csv")
+    cond1, cond2 = (CONDITION_NAMES.get(cond.lower(), cond.lower()) for cond in match.group('cond1', 'cond2'))
+    if cond2 == 'mock':
+        return cond2, cond1, True
+    return cond1, cond2, False
+
+
+def comparison_name(path):
+    # deseq2_Avian_vs_Mock_full_extended.csv -> mock-avian, deseq2_swine_vs_reass_full.csv -> swine-reass
+    cond1, cond2, _ = comparison_conditions(path)
+    return f'{cond1}-{cond2}'
+
+
+def read_deseq2_columns(path, values=('padj',), gene_ids=None, chunksize=None, reverse=False):
+    # -> DataFrame gene ID x values, only the ID and value columns are parsed. Columns are found by their header name:
+    # combine-pvalues.rb took field 11, which is padj in the *_full_extended.csv files but past the end of the
+    # 6-column *_full.csv files in input-data (padj is field 5 there).
+    # With gene_ids the file is read in chunks and only those rows are kept.
+    # reverse: the column is named the other way round (reass-swine for deseq2_swine_vs_reass_full.csv)
+    header = pd.read_csv(path, nrows=0).columns
+    missing = [value for value in values if value not in header]
+    if missing:
+        raise ValueError(f"{path}: no {', '.join(missing)} column (columns: {', '.join(header)})")
+    id_column = header[0]  # unnamed ("") in the *_full.csv files, ID in the *_extended.csv files
+    dtypes = {value: np.float64 for value in values}
+    dtypes[id_column] = str
+    reader = pd.read_csv(path, usecols=[id_column, *values], dtype=dtypes, float_precision='round_trip',
+                         chunksize=chunksize or (100_000 if gene_ids is not None else None))
+    if gene_ids is None:
+        df = reader
+    else:
+        wanted = pd.Index(gene_ids)
+        df = pd.concat([chunk[chunk[id_column].isin(wanted)] for chunk in reader])
+    df = df.drop_duplicates(id_column).set_index(id_column)[list(values)]
+    df.index.name = 'ID'
+    if 'log2FoldChange' in df.columns and comparison_conditions(path)[2] != reverse:
+        # DESeq2's fold change is log2(first / second condition of the file name), keep it log2(first / second) of the column name
+        df['log2FoldChange'] = -df['log2FoldChange']
+    return df
+
+
+def combine_deseq2(paths, values=('padj',), gene_ids=None, workers=None, comparisons=None):
+    # {value: gene x comparison DataFrame} from all DESeq2 tables, read in parallel, each file once for all values.
+    # All comparisons are outer-joined on ID at once; IDs missing in a comparison stay NaN.
+    # comparisons: names and column order of existing tables or a design (reass-swine, not the file's swine-reass)
+    paths = sorted(paths)
+    if not paths:
+        raise FileNotFoundError("No DESeq2 tables given")
+    names = [oriented_name(comparison_name(path), comparisons) for path in paths]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Several DESeq2 tables for the same comparison: {', '.join(names)}")
+    reverse = [name != comparison_name(path) for name, path in zip(names, paths)]
+    with ThreadPoolExecutor(max_workers=workers or min(len(paths), os.cpu_count() or 1)) as pool:
+        tables = list(pool.map(lambda args: read_deseq2_columns(args[0], values, gene_ids, reverse=args[1]), zip(paths, reverse)))
+
+    merged = pd.concat(tables, axis=1, keys=names, join='outer').sort_index()
+    merged.index.name = 'ID'
+    if comparisons is not None:
+        # in the given order, any others after them sorted like the Ruby script did
+        names = [name for name in comparisons if name in names] + [name for name in names if name not in comparisons]
+    combined = {}
+    for value in values:
+        combined[value] = merged.xs(value, axis=1, level=1)[names]
+        for name in names:
+            n_missing = int(combined[value][name].isna().sum())
+            if n_missing:
+                print(f"{n_missing} gene IDs have no {value} for {name}")
+    if gene_ids is not None:
+        n_unknown = len(set(gene_ids)) - len(merged)
+        if n_unknown:
+            print(f"{n_unknown} of the requested gene IDs are in none of the DESeq2 tables")
+    print(f"{len(merged)} gene IDs from {len(paths)} comparisons")
+    return combined
+
+
+def combine_pvalues(paths, value='padj', gene_ids=None, workers=None, comparisons=None):
+    # Gene x comparison table (ID, <cond1>-<cond2>, ...) from all DESeq2 tables.
+    # Replaces combine-pvalues.rb: IDs missing in a comparison stay NaN (not significant) instead of the
+    # 0.05 the Ruby script filled in, which was drawn as a '*'.
+    return combine_deseq2(paths, [value], gene_ids, workers, comparisons)[value].reset_index()
+
+
+def write_pval_table(pval_df, pval_file):
+    pval_df.to_csv(pval_file, sep="\t", index=False, na_rep='NA')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Combine the DESeq2 *_full.csv tables into one p-value table (replaces combine-pvalues.rb).')
+    parser.add_argument('input_dir', help=f'folder with the {PATTERN} files, e.g. input-data')
+    parser.add_argument('output', help='table to write, e.g. input-data/pvals-all-human-comparisons.tsv')
+    parser.add_argument('--value', choices=VALUE_COLUMNS, default='padj', help='DESeq2 column to combine (default: padj)')
+    parser.add_argument('--comparisons', nargs='+', help='only these comparisons, named and ordered as given (either orientation), e.g. avian-reass reass-swine avian-swine')
+    parser.add_argument('--genes-file', help='only these gene IDs (one per line), the other rows are never kept in memory')
+    parser.add_argument('--workers', type=int, default=None, help='files read in parallel (default: one thread per file, up to the number of cores)')
+    args = parser.parse_args()
+
+    paths = glob.glob(os.path.join(args.input_dir, PATTERN))
+    if args.comparisons:
+        paths = [path for path in paths if oriented_name(comparison_name(path), args.comparisons) in args.comparisons]
+        found = {oriented_name(comparison_name(path), args.comparisons) for path in paths}
+        missing = [comparison for comparison in args.comparisons if comparison not in found]
+        if missing:
+            parser.error(f"no DESeq2 table in {args.input_dir} for {', '.join(missing)}")
+    gene_ids = read_gene_list(args.genes_file) if args.genes_file else None
+    write_pval_table(combine_pvalues(paths, args.value, gene_ids, args.workers, args.comparisons), args.output)
@@ -0,0 +1,74 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# Same column order as the tpms-human.tsv written by combine-tpms.rb
+CONDITIONS = ['mock', 'swine', 'avian', 'reass']
+
+
+def read_condition_tpms(tsv, condition, dtype=np.float32):
+    # <condition>_reps_tpms.tsv: ID, rep1, rep2, ..., mean
+    # Parsed exactly as float64 (float_precision='round_trip'), so writing the table back gives the source digits like
+    # combine-tpms.rb did; dtype=np.float32 (the default) is only for the in-memory store
+    columns = pd.read_csv(tsv, sep="\t", nrows=0).columns
+    rep_columns = [col for col in columns if col.startswith('rep')]
+    dtypes = {col: np.float64 for col in rep_columns}
+    dtypes['ID'] = str
+    df = pd.read_csv(tsv, sep="\t", usecols=['ID'] + rep_columns, dtype=dtypes, float_precision='round_trip')
+    df = df.drop_duplicates('ID').set_index('ID').astype(dtype)
+    df.columns = [f'{condition}-{col}' for col in rep_columns]
+    return df
+
+
+def read_gene_names(names_file):
+    # DESeq2 *_extended.csv from RNAflow: ID,geneName,...
+    names = pd.read_csv(names_file, usecols=[0, 1], dtype=str)
+    names.columns = ['ID', 'Name']
+    return names.drop_duplicates('ID').set_index('ID')['Name']
+
+
+def combine_tpms(input_dir, conditions=CONDITIONS, names_file=None, missing='nan', dtype=np.float32):
+    # dtype=np.float64 for write_tpm_table, float32 for an ExpressionStore
+    tables = [read_condition_tpms(os.path.join(input_dir, f'{condition}_reps_tpms.tsv'), condition, dtype) for condition in conditions]
+
+    # Outer join on ID over all conditions at once, sorted like the Ruby script did
+    merged = pd.concat(tables, axis=1, join='outer').sort_index()
+    merged.index.name = 'ID'
+
+    for condition, table in zip(conditions, tables):
+        n_missing = len(merged) - len(table)
+        if n_missing:
+            print(f"{n_missing} gene IDs have no TPM values for {condition}")
+    if missing == 'drop':
+        merged = merged.dropna()
+    elif missing == 'zero':
+        merged = merged.fillna(0.0)
+    elif missing != 'nan':
+        raise ValueError(f"missing must be 'nan', 'drop' or 'zero', not {missing!r}")
+
+    if names_file is not None:
+        names = read_gene_names(names_file).reindex(merged.index).fillna('')
+    else:
+        names = pd.Series('', index=merged.index)
+    merged.insert(0, 'Name', names.astype('category'))
+
+    print(f"{len(merged)} gene IDs from {', '.join(conditions)}")
+    return merged.reset_index()
+
+
+def write_tpm_table(tpm_df, tpm_file):
+    tpm_df.to_csv(tpm_file, sep="\t", index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the per-condition *_reps_tpms.tsv files into one TPM table (replaces combine-tpms.rb).')
+    parser.add_argument('input_dir', help='folder with the <condition>_reps_tpms.tsv files')
+    parser.add_argument('output', help='merged TPM table to write, e.g. input-data/tpms-human.tsv')
+    parser.add_argument('--names', help='DESeq2 *_extended.csv with ID,geneName columns to attach gene names')
+    parser.add_argument('--conditions', nargs='+', default=CONDITIONS)
+    parser.add_argument('--missing', choices=['nan', 'drop', 'zero'], default='nan', help='how to fill genes missing in a condition')
+    args = parser.parse_args()
+
+    write_tpm_table(combine_tpms(args.input_dir, args.conditions, args.names, args.missing, dtype=np.float64), args.output)
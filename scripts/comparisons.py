@@ -0,0 +1,100 @@
+from collections import namedtuple
+
+import numpy as np
+
+from design import default_design
+
+# Upper p-value bound per significance label, from the strictest one
+significance_levels = [(0.001, '***'), (0.01, '**'), (0.05, '*')]
+_thresholds = np.array([threshold for threshold, _ in significance_levels])
+# Index = category from classify_pvals, the last one is "not significant"
+star_labels = [stars for _, stars in significance_levels] + [None]
+
+SignificantComparison = namedtuple('SignificantComparison', ['cond1', 'cond2', 'x1', 'x2', 'pval', 'stars'])
+
+
+def classify_pvals(pvals):
+    # Category per p-value in one pass: 0 = ***, 1 = **, 2 = *, 3 = not significant (also NaN)
+    pvals = np.asarray(pvals, dtype=np.float64)
+    return np.where(np.isnan(pvals), len(_thresholds), np.digitize(pvals, _thresholds, right=True))
+
+
+class ComparisonSchema:
+    """p-value table header parsed once into condition pairs and x positions."""
+
+    def __init__(self, pval_columns, design=default_design):
+        # 'avian-reass' -> ('Avian', 'Reassortant'), x positions in the design's plotting order.
+        # Every comparison the design selects must be a column (either orientation), else ValueError.
+        design.check_comparisons(list(pval_columns))
+        positions = {cond: i for i, cond in enumerate(design.labels)}
+        self.columns, self.cond1, self.cond2, self.column_index = [], [], [], []
+        for i, col in enumerate(pval_columns):
+            try:
+                pair = design.comparison(col)
+            except ValueError as e:
+                print(f"Skipping {col}: {e}")
+                continue
+            if pair is None:
+                continue
+            cond1, cond2 = pair
+            self.columns.append(col)
+            self.cond1.append(cond1)
+            self.cond2.append(cond2)
+            self.column_index.append(i)
+        self.x1 = np.array([positions[cond] for cond in self.cond1], dtype=int)
+        self.x2 = np.array([positions[cond] for cond in self.cond2], dtype=int)
+
+
+class SignificanceTable:
+    """Star category of every gene x comparison, classified once for the whole p-value table or read per row."""
+
+    def __init__(self, gene_ids, pvals, schema, rows=None, categories=None):
+        # rows: gene ID -> row lookup to use instead of building a dict (e.g. MappedStore's shared index).
+        # pvals and categories (e.g. precomputed in MappedStore's cache) cover all p-value columns: row() only reads
+        # one row of them, the comparison columns of the whole table are built on first use of .pvals/.categories.
+        self.schema = schema
+        self._rows = rows if rows is not None else {gene_id: i for i, gene_id in enumerate(gene_ids)}
+        self._all_pvals = pvals
+        self._all_categories = categories
+        self._columns = np.asarray(schema.column_index, dtype=np.intp)
+        self._pvals = None
+        self._categories = None
+
+    @classmethod
+    def from_store(cls, store, design=None):
+        schema = ComparisonSchema(store.pval_columns, design if design is not None else store.design)
+        return cls(store.pval_gene_ids(), store.pvals.to_numpy(dtype=np.float64), schema)
+
+    @property
+    def pvals(self):
+        # gene x comparison p-values of the whole table
+        if self._pvals is None:
+            self._pvals = np.asarray(self._all_pvals[:, self._columns], dtype=np.float64)
+        return self._pvals
+
+    @property
+    def categories(self):
+        if self._categories is None:
+            if self._all_categories is not None:
+                self._categories = np.asarray(self._all_categories[:, self._columns])
+            else:
+                self._categories = classify_pvals(self.pvals)
+        return self._categories
+
+    def _row_values(self, i):
+        # Whole-table arrays if they were built already (each one on its own), else straight from row i
+        pvals = self._pvals[i] if self._pvals is not None else np.asarray(self._all_pvals[i], dtype=np.float64)[self._columns]
+        if self._categories is not None:
+            return pvals, self._categories[i]
+        if self._all_categories is not None:
+            return pvals, np.asarray(self._all_categories[i])[self._columns]
+        return pvals, classify_pvals(pvals)
+
+    def row(self, gene_id):
+        # Significant comparisons of one gene, in p-value column order
+        pvals, categories = self._row_values(self._rows[gene_id])
+        schema = self.schema
+        return [
+            SignificantComparison(schema.cond1[j], schema.cond2[j], schema.x1[j], schema.x2[j], pvals[j], star_labels[categories[j]])
+            for j in np.flatnonzero(categories < len(significance_levels))
+        ]
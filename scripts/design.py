@@ -0,0 +1,169 @@
+import colorsys
+import json
+import re
+from collections import namedtuple
+
+import numpy as np
+
+# One condition of the experiment. key is the prefix of its replicate columns in the TPM table and its name
+# in the p-value column headers (reass -> reass-rep1, avian-reass), label is the name shown in the plots.
+# replicates=None takes all <key>-rep<N> columns of the table, so a fourth replicate needs no code change.
+Condition = namedtuple('Condition', ['key', 'label', 'color', 'replicates'], defaults=(None,))
+
+
+def parse_color(color):
+    # '#9bbef5ff', '#9bbef5' or an RGB(A) tuple of 0-1 floats -> RGBA tuple
+    if isinstance(color, str):
+        digits = color.lstrip('#')
+        if len(digits) not in (6, 8):
+            raise ValueError(f"Color {color!r} is not #rrggbb or #rrggbbaa")
+        rgba = [int(digits[i:i + 2], 16) / 255 for i in range(0, len(digits), 2)]
+    else:
+        rgba = [float(value) for value in color]
+    return tuple(rgba + [1.0] * (4 - len(rgba)))
+
+
+def default_colors(n):
+    # Pale, evenly spaced hues for conditions without a color of their own
+    return [colorsys.hls_to_rgb(i / max(n, 1), 0.8, 0.7) + (1.0,) for i in range(n)]
+
+
+def oriented_name(column, comparisons):
+    # 'swine-reass' -> 'reass-swine' if that is how comparisons names it, else the column unchanged
+    if comparisons is None or column in comparisons:
+        return column
+    reverse = '-'.join(column.split('-')[::-1])
+    return reverse if reverse in comparisons else column
+
+
+class Design:
+    """Conditions in plotting order with their colors, replicate columns and comparisons."""
+
+    def __init__(self, conditions, comparisons=None):
+        colors = default_colors(len(conditions))
+        self.conditions = [
+            Condition(cond.key, cond.label, parse_color(cond.color) if cond.color is not None else colors[i],
+                      list(cond.replicates) if cond.replicates is not None else None)
+            for i, cond in enumerate(conditions)
+        ]
+        self.keys = [cond.key for cond in self.conditions]
+        self.labels = [cond.label for cond in self.conditions]
+        if len(set(self.keys)) != len(self.keys) or len(set(self.labels)) != len(self.labels):
+            raise ValueError("Condition keys and labels must be unique")
+        self.palette = {cond.label: cond.color for cond in self.conditions}
+        # p-value columns to annotate, None = every column that compares two conditions of the design
+        self.comparisons = list(comparisons) if comparisons is not None else None
+        self._names = {}
+        for cond in self.conditions:
+            self._names[cond.key.lower()] = cond.label
+            self._names[cond.label.lower()] = cond.label
+        self._column_index = {}
+
+    @classmethod
+    def from_json(cls, path):
+        # {"conditions": [{"key": "mock", "label": "Mock", "color": "#ffffffff", "replicates": [...]}, ...],
+        #  "comparisons": ["avian-reass", ...]}  -- label, color, replicates and comparisons are optional
+        with open(path) as fh:
+            spec = json.load(fh)
+        conditions = [Condition(cond['key'], cond.get('label', cond['key'].capitalize()), cond.get('color'), cond.get('replicates'))
+                      for cond in spec['conditions']]
+        return cls(conditions, spec.get('comparisons'))
+
+    @classmethod
+    def from_columns(cls, tpm_columns):
+        # All <key>-rep<N> conditions of a table header, in column order (e.g. synthetic tables with 20 conditions).
+        # Known conditions keep their label and color.
+        known = {cond.key: cond for cond in default_design.conditions}
+        keys = []
+        for col in tpm_columns:
+            match = _replicate_pattern.match(col)
+            if match and match.group(1) not in keys:
+                keys.append(match.group(1))
+        return cls([known[key] if key in known else Condition(key, key.capitalize(), None) for key in keys])
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def select(self, labels):
+        # Design with only the given conditions, in design order
+        keep = set(labels)
+        unknown = keep - set(self.labels)
+        if unknown:
+            raise ValueError(f"Unknown condition(s): {', '.join(sorted(unknown))}")
+        return Design([cond for cond in self.conditions if cond.label in keep], self.comparisons)
+
+    def without(self, label):
+        return self.select([cond for cond in self.labels if cond != label])
+
+    def label(self, name):
+        # 'reass' or 'reassortant' -> 'Reassortant', None if not in the design
+        return self._names.get(name.lower())
+
+    def comparison(self, column):
+        # 'avian-reass' -> ('Avian', 'Reassortant'), None if a side is not in the design or the column not selected.
+        # A selected comparison matches in either orientation (swine-reass for reass-swine), the conditions are
+        # returned in the column's order.
+        parts = column.split('-')
+        if len(parts) != 2:
+            raise ValueError(f"expected <condition>-<condition>, got {len(parts)} part(s)")
+        if self.comparisons is not None and oriented_name(column, self.comparisons) not in self.comparisons:
+            return None
+        cond1, cond2 = (self.label(part) for part in parts)
+        if cond1 is None or cond2 is None:
+            return None
+        return cond1, cond2
+
+    def check_comparisons(self, columns, source='the p-value table'):
+        # ValueError naming the selected comparisons that no column matches in either orientation
+        if self.comparisons is None:
+            return
+        found = {oriented_name(col, self.comparisons) for col in columns}
+        missing = [comparison for comparison in self.comparisons if comparison not in found]
+        if missing:
+            raise ValueError(f"Comparison(s) {', '.join(missing)} of the design not in {source} (columns: {', '.join(map(str, columns))})")
+
+    def replicate_columns(self, tpm_columns):
+        # {label: [replicate columns]} for a table header
+        index = self.column_index(tpm_columns)
+        tpm_columns = list(tpm_columns)
+        return {label: [tpm_columns[i] for i in row] for label, row in zip(self.labels, index)}
+
+    def column_index(self, tpm_columns):
+        # (conditions, replicates) positions of the replicate columns in the header, resolved once per header.
+        # values[:, index] then gives every condition group of all genes in one take.
+        header = tuple(tpm_columns)
+        if header not in self._column_index:
+            self._column_index[header] = self._resolve(header)
+        return self._column_index[header]
+
+    def _resolve(self, header):
+        positions = {col: i for i, col in enumerate(header)}
+        index = []
+        for cond in self.conditions:
+            if cond.replicates is not None:
+                missing = [col for col in cond.replicates if col not in positions]
+                if missing:
+                    raise ValueError(f"TPM table has no column(s) {', '.join(missing)} for condition {cond.label}")
+                index.append([positions[col] for col in cond.replicates])
+            else:
+                reps = sorted((int(match.group(2)), i) for i, match in ((i, _replicate_pattern.match(col)) for i, col in enumerate(header))
+                              if match and match.group(1) == cond.key)
+                if not reps:
+                    raise ValueError(f"TPM table has no {cond.key}-rep<N> columns for condition {cond.label}")
+                index.append([i for _, i in reps])
+        n_reps = {len(row) for row in index}
+        if len(n_reps) != 1:
+            counts = ', '.join(f'{label}: {len(row)}' for label, row in zip(self.labels, index))
+            raise ValueError(f"All conditions need the same number of replicates ({counts})")
+        return np.array(index, dtype=np.intp)
+
+
+_replicate_pattern = re.compile(r'^(.+)-rep(\d+)$')
+
+# The influenza experiment: mock-infected cells and three viruses, columns as in tpms-human.tsv
+default_design = Design([
+    Condition('mock', 'Mock', (1.0, 1.0, 1.0, 1.0)),                    # white
+    Condition('avian', 'Avian', (0.9490, 0.6392, 0.6392, 1.0)),         # red, f2a3a3ff
+    Condition('swine', 'Swine', (0.7137, 0.9804, 0.6784, 1.0)),         # green, b6faadff
+    Condition('reass', 'Reassortant', (0.6078, 0.7451, 0.9608, 1.0)),   # blue, 9bbef5ff
+])
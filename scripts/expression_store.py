@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+
+from comparisons import SignificanceTable
+from design import default_design
+from stage_profiler import stage
+from table_cache import cached_read
+
+
+def read_tpm_table(tpm_file):
+    # Read the header first so all replicate columns can be parsed straight to float32
+    columns = pd.read_csv(tpm_file, sep="\t", nrows=0).columns
+    dtypes = {col: np.float32 for col in columns if col not in ('ID', 'Name')}
+    dtypes['ID'] = str
+    if 'Name' in columns:
+        dtypes['Name'] = 'category'
+    return pd.read_csv(tpm_file, sep="\t", dtype=dtypes)
+
+
+def read_pval_table(pval_file):
+    # p-values stay float64: DESeq2 padj values go down to 1e-90 and would underflow to 0 in float32
+    columns = pd.read_csv(pval_file, sep="\t", nrows=0).columns
+    dtypes = {col: np.float64 for col in columns if col != 'ID'}
+    dtypes['ID'] = str
+    return pd.read_csv(pval_file, sep="\t", dtype=dtypes)
+
+
+def read_deseq2_table(deseq2_file):
+    # DESeq2 *_full.csv: unnamed first column holds the gene ID
+    df = pd.read_csv(deseq2_file, dtype={0: str})
+    return df.rename(columns={df.columns[0]: 'ID'})
+
+
+def load_tpm_table(tpm_file, cache=True):
+    return cached_read(tpm_file, read_tpm_table) if cache else read_tpm_table(tpm_file)
+
+
+def load_pval_table(pval_file, cache=True):
+    return cached_read(pval_file, read_pval_table) if cache else read_pval_table(pval_file)
+
+
+def load_deseq2_table(deseq2_file, cache=True):
+    return cached_read(deseq2_file, read_deseq2_table) if cache else read_deseq2_table(deseq2_file)
+
+
+class ExpressionStore:
+    """TPM and adjusted p-value tables loaded once and indexed by gene ID."""
+
+    def __init__(self, tpm_df, pval_df, design=None):
+        self.tpm = tpm_df.drop_duplicates('ID').set_index('ID')
+        self.pvals = pval_df.dropna(subset=['ID']).drop_duplicates('ID').set_index('ID')
+        self.tpm_columns = [col for col in self.tpm.columns if col != 'Name']
+        self.pval_columns = list(self.pvals.columns)
+        # Conditions, colors and comparisons of the plots (mock/avian/swine/reass unless given)
+        self.design = design if design is not None else default_design
+        self._tpm_matrix = None
+        self._significance = None
+
+    @classmethod
+    def from_files(cls, tpm_file, pval_file, cache=True, design=None):
+        # With cache=True the parsed tables are kept as .npy columns and reused until the source file changes
+        with stage('load_tpm'):
+            tpm_df = load_tpm_table(tpm_file, cache)
+        with stage('load_pvals'):
+            pval_df = load_pval_table(pval_file, cache)
+        return cls(tpm_df, pval_df, design)
+
+    def __contains__(self, gene_id):
+        return gene_id in self.tpm.index and gene_id in self.pvals.index
+
+    def gene_ids(self):
+        # IDs present in both tables, in p-value table order
+        return [gene_id for gene_id in self.pvals.index if gene_id in self.tpm.index]
+
+    def tpm_gene_ids(self):
+        # All IDs of the TPM table, in table order
+        return self.tpm.index
+
+    def pval_gene_ids(self):
+        # All IDs of the p-value table, in table order (the rows of significance())
+        return self.pvals.index
+
+    def gene_name(self, gene_id):
+        # Get gene name or fallback to ID
+        if 'Name' not in self.tpm.columns:
+            return gene_id
+        gene_name = self.tpm.at[gene_id, 'Name']
+        if pd.isna(gene_name) or str(gene_name).strip() == "":
+            return gene_id
+        return str(gene_name)
+
+    def tpm_values(self, gene_id, columns):
+        return self.tpm.loc[gene_id, columns].to_numpy(dtype=np.float32)
+
+    def tpm_matrix(self):
+        # All replicate columns as one float32 array, rows in TPM table order
+        if self._tpm_matrix is None:
+            self._tpm_matrix = self.tpm[self.tpm_columns].to_numpy(dtype=np.float32)
+        return self._tpm_matrix
+
+    def condition_values(self, gene_ids=None, design=None):
+        # (genes, conditions, replicates) TPM array: gene rows and the design's column index
+        # (resolved once per header) are applied in a single take
+        index = (design if design is not None else self.design).column_index(self.tpm_columns)
+        matrix = self.tpm_matrix()
+        if gene_ids is None:
+            return matrix[:, index]
+        rows = self.tpm.index.get_indexer(gene_ids)
+        if (rows < 0).any():
+            missing = [gene_id for gene_id, row in zip(gene_ids, rows) if row < 0]
+            raise KeyError(f"Gene ID(s) not in the TPM table: {', '.join(map(str, missing[:5]))}")
+        return matrix[rows[:, None, None], index]
+
+    def pval_row(self, gene_id):
+        return self.pvals.loc[gene_id]
+
+    def significance(self):
+        # Comparison columns parsed and star categories computed for the whole table on first use
+        if self._significance is None:
+            with stage('significance'):
+                self._significance = SignificanceTable.from_store(self)
+        return self._significance
@@ -0,0 +1,231 @@
+import contextlib
+import io
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from stage_profiler import stage
+
+FORMATS = ('pdf', 'png', 'svg')
+# Set to 1 to run the plotting scripts as batch jobs: show() never opens a window
+BATCH_ENV = 'RNASEQ_BATCH'
+# Resolution of the rasterized layers in PDF/SVG output
+RASTER_DPI = 300
+# rasterize='auto' turns the points into an image from this many points per square inch of axes on. Below that the
+# vector markers are smaller and faster than a 300 dpi image of the plot area (e.g. 3 replicates x 40 genes), above
+# it they are not (10 genes x 1000 points: PDF 614 -> 100 KB, SVG 3 MB -> 0.5 MB).
+RASTER_MIN_POINT_DENSITY = 50
+RASTER_MODES = ('auto', 'points', 'all')
+
+# Size and time (savefig + write) of one output file
+FileReport = namedtuple('FileReport', ['path', 'nbytes', 'seconds'])
+
+
+@contextlib.contextmanager
+def atomic_output(path):
+    # Yields a temporary name next to path that is renamed to path only when the block succeeds, so a crash, a kill
+    # or a failed write never leaves a partial file under the final name (a complete older file stays until then).
+    # The name is unique per process and thread, a killed run leaves at most hidden .<name>.*.tmp files behind.
+    folder, name = os.path.split(path)
+    tmp = os.path.join(folder, f'.{name}.{os.getpid()}-{threading.get_ident()}.tmp')
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+
+
+def _write_png(path, rgba, size, dpi):
+    # PNG compression is the slow part, it runs in the writer thread
+    with atomic_output(path) as tmp:
+        Image.frombuffer('RGBA', size, rgba, 'raw', 'RGBA', 0, 1).save(tmp, format='PNG', dpi=(dpi, dpi))
+
+
+def _write_bytes(path, data):
+    with atomic_output(path) as tmp:
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+
+
+def rasterize_dense_layers(ax, mode='auto'):
+    # Call after boxes and points are drawn and before the brackets: the points ('points', or 'auto' when they are
+    # dense enough) and with 'all' also the box patches, whiskers and medians go into PDF/SVG output as an embedded
+    # image, while text, axes, ticks and the significance brackets stay vectors. Returns the number of rasterized artists.
+    if mode not in RASTER_MODES:
+        raise ValueError(f"rasterize must be one of {', '.join(RASTER_MODES)}, not {mode!r}")
+    if mode == 'auto':
+        n_points = sum(len(collection.get_offsets()) for collection in ax.collections)
+        width, height = ax.get_position().size * ax.figure.get_size_inches()
+        if n_points < RASTER_MIN_POINT_DENSITY * width * height:
+            return 0
+    artists = list(ax.collections)
+    if mode == 'all':
+        artists += list(ax.patches) + list(ax.lines)
+    for artist in artists:
+        artist.set_rasterized(True)
+    return len(artists)
+
+
+def show():
+    # plt.show() for interactive use of the scripts. Batch jobs (RNASEQ_BATCH=1) and non-interactive backends
+    # (Agg, e.g. on nodes without a display) return right away instead of waiting for windows to be closed.
+    import matplotlib
+    if os.environ.get(BATCH_ENV) == '1' or matplotlib.get_backend().lower() in ('agg', 'pdf', 'svg', 'ps', 'cairo', 'template'):
+        return
+    import matplotlib.pyplot as plt
+    plt.show()
+
+
+def vector_dpi(raster_dpi=None):
+    # savefig dpi for PDF/SVG: only the rasterized layers depend on it, 'figure' keeps the plain vector output as before
+    return raster_dpi or 'figure'
+
+
+def save_figure(fig, path, fmt, dpi=300, raster_dpi=None):
+    # One savefig straight to disk (through a temporary file), PNG at dpi, PDF/SVG with rasterized layers at raster_dpi
+    start = time.perf_counter()
+    with stage(f'savefig_{fmt}'), atomic_output(path) as tmp:
+        fig.savefig(tmp, format=fmt, dpi=dpi if fmt == 'png' else vector_dpi(raster_dpi))
+    return FileReport(path, os.path.getsize(path), time.perf_counter() - start)
+
+
+def print_file_reports(reports):
+    # One line per written file, then the total
+    for report in reports:
+        print(f"{report.path}\t{report.nbytes / 1024:.1f} KB\t{report.seconds:.3f} s")
+    if len(reports) > 1:
+        print(f"{len(reports)} files\t{sum(r.nbytes for r in reports) / 1024:.1f} KB\t{sum(r.seconds for r in reports):.3f} s")
+
+
+def render_formats(fig, formats=FORMATS, dpi=300, raster_dpi=None):
+    # Draw the figure in the calling thread (matplotlib is not thread-safe) and return
+    # one (writer, args, seconds) job per format, the jobs only touch bytes and the file system.
+    # The raster formats share a single Agg draw, the vector backends need their own pass.
+    jobs = {}
+    if 'png' in formats:
+        buf = io.BytesIO()
+        start = time.perf_counter()
+        with stage('savefig_png'):
+            fig.savefig(buf, format='rgba', dpi=dpi)
+        width, height = fig.get_size_inches() * dpi
+        jobs['png'] = (_write_png, (buf.getvalue(), (int(width), int(height)), dpi), time.perf_counter() - start)
+    for fmt in formats:
+        if fmt == 'png':
+            continue
+        buf = io.BytesIO()
+        start = time.perf_counter()
+        with stage(f'savefig_{fmt}'):
+            fig.savefig(buf, format=fmt, dpi=vector_dpi(raster_dpi))
+        jobs[fmt] = (_write_bytes, (buf.getvalue(),), time.perf_counter() - start)
+    return jobs
+
+
+def _traced_write(writer, fmt, key, path, render_seconds, *args):
+    # Runs in a writer thread, which has no current gene of its own. Returns the file's FileReport.
+    start = time.perf_counter()
+    with stage(f'write_{fmt}', key):
+        writer(path, *args)
+    return FileReport(path, os.path.getsize(path), render_seconds + time.perf_counter() - start)
+
+
+class FigureWriteError(OSError):
+    """A background write failed, with the key (gene ID) of the figure it belonged to."""
+
+    def __init__(self, key, path, error, n_failed=1):
+        super().__init__(f"Writing {path} for {key} failed ({n_failed} figure(s) in total): {error!r}")
+        self.key = key
+        self.path = path
+        self.error = error
+
+
+class FigureExporter:
+    """Writes the requested formats of each figure from a thread pool, with a bounded queue of rendered bytes."""
+
+    def __init__(self, formats=FORMATS, dpi=300, workers=2, max_pending_mb=64, raster_dpi=None, on_written=None):
+        unknown = set(formats) - set(FORMATS)
+        if unknown:
+            raise ValueError(f"Unsupported output format(s): {', '.join(sorted(unknown))}")
+        self.formats = tuple(formats)
+        self.dpi = dpi
+        self.raster_dpi = raster_dpi
+        # FileReport of every written file
+        self.reports = []
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._pending = []
+        # Backpressure: export() waits while the rendered but unwritten files exceed the budget
+        # (a 1200x1200 PNG is ~5.8 MB of RGBA), so a fast render loop cannot outrun the disk
+        self.max_pending_bytes = max_pending_mb * 1024 * 1024
+        self._pending_bytes = 0
+        self._written = threading.Condition()
+        # on_written(key) is called (in a writer thread) once every file of a figure is on disk, e.g. to checkpoint it
+        self.on_written = on_written
+
+    def _release(self, nbytes):
+        with self._written:
+            self._pending_bytes -= nbytes
+            self._written.notify_all()
+
+    def export(self, fig, path_base, key=None):
+        # Returns as soon as the figure is drawn, so the caller can reuse it for the next gene
+        key = key or path_base
+        jobs = render_formats(fig, self.formats, self.dpi, self.raster_dpi)
+        nbytes = sum(len(args[0]) for _, args, _ in jobs.values())
+        with self._written:
+            if self._pending_bytes and self._pending_bytes + nbytes > self.max_pending_bytes:
+                with stage('export_wait'):
+                    self._written.wait_for(lambda: not self._pending_bytes or self._pending_bytes + nbytes <= self.max_pending_bytes)
+            self._pending_bytes += nbytes
+        futures = []
+        for fmt, (writer, args, seconds) in jobs.items():
+            path = f'{path_base}.{fmt}'
+            future = self._pool.submit(_traced_write, writer, fmt, key, path, seconds, *args)
+            future.add_done_callback(lambda _, size=len(args[0]): self._release(size))
+            self._pending.append((key, path, future))
+            futures.append(future)
+        if self.on_written is not None:
+            remaining = [len(futures)]
+            lock = threading.Lock()
+
+            def written(_):
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0]:
+                        return
+                if all(future.exception() is None for future in futures):
+                    self.on_written(key)
+
+            for future in futures:
+                future.add_done_callback(written)
+
+    def wait(self):
+        # Block until every queued file is written, failed writes are returned as {key: (path, error)}
+        pending, self._pending = self._pending, []
+        errors = {}
+        for key, path, future in pending:
+            error = future.exception()
+            if error is None:
+                self.reports.append(future.result())
+            elif key not in errors:
+                errors[key] = (path, error)
+        return errors
+
+    def close(self):
+        try:
+            errors = self.wait()
+        finally:
+            self._pool.shutdown()
+        if errors:
+            key, (path, error) = next(iter(errors.items()))
+            raise FigureWriteError(key, path, error, len(errors)) from error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+
+from expression_store import load_tpm_table
+from table_cache import cached_read
+
+# Column names accepted in annotation files, e.g. our ID/Name/Aliases TSV, an RNAflow
+# DESeq2 *_extended.csv (ID,geneName) or an HGNC download
+_id_columns = ['ID', 'Ensembl gene ID', 'Ensembl ID(supplied by Ensembl)']
+_name_columns = ['Name', 'geneName', 'Approved symbol', 'symbol']
+_alias_columns = ['Aliases', 'Alias symbols', 'Previous symbols', 'alias']
+
+# Preferred match when a query hits several kinds of keys
+KINDS = ['id', 'symbol', 'alias']
+
+
+def _split_aliases(value):
+    return [alias.strip() for alias in str(value).replace('|', ',').replace(';', ',').split(',') if alias.strip()]
+
+
+def read_annotation(annotation_file):
+    # -> rows of (ID, label, kind) for every symbol and alias in the file
+    sep = ',' if annotation_file.endswith('.csv') else '\t'
+    df = pd.read_csv(annotation_file, sep=sep, dtype=str)
+    id_col = next((col for col in _id_columns if col in df.columns), None)
+    if id_col is None:
+        raise ValueError(f"{annotation_file}: no gene ID column (one of {', '.join(_id_columns)})")
+    df = df.dropna(subset=[id_col])
+    rows = []
+    for col in _name_columns:
+        if col in df.columns:
+            names = df[[id_col, col]].dropna()
+            rows += [(gene_id, name.strip(), 'symbol') for gene_id, name in names.itertuples(index=False) if name.strip()]
+    for col in _alias_columns:
+        if col in df.columns:
+            aliases = df[[id_col, col]].dropna()
+            rows += [(gene_id, alias, 'alias') for gene_id, value in aliases.itertuples(index=False) for alias in _split_aliases(value)]
+    return pd.DataFrame(rows, columns=['ID', 'label', 'kind'])
+
+
+def build_index_table(tpm_df, annotation_file=None):
+    # Every ID and gene name of the TPM table plus the annotation's symbols and aliases,
+    # sorted by lower-case key so exact and prefix queries are binary searches
+    ids = tpm_df['ID'].dropna().astype(str)
+    parts = [pd.DataFrame({'ID': ids, 'label': ids, 'kind': 'id'})]
+    if 'Name' in tpm_df.columns:
+        names = tpm_df[['ID', 'Name']].dropna()
+        names = names[names['Name'].astype(str).str.strip() != '']
+        parts.append(pd.DataFrame({'ID': names['ID'].astype(str), 'label': names['Name'].astype(str), 'kind': 'symbol'}))
+    if annotation_file is not None:
+        parts.append(read_annotation(annotation_file))
+    table = pd.concat(parts, ignore_index=True)
+    table['key'] = table['label'].str.lower()
+    table['rank'] = table['kind'].map({kind: i for i, kind in enumerate(KINDS)})
+    table = table.drop_duplicates(['key', 'ID']).sort_values(['key', 'rank', 'ID'], kind='stable')
+    return table[['key', 'ID', 'label', 'kind']].reset_index(drop=True)
+
+
+class GeneIndex:
+    """Gene IDs, names and aliases with exact and case-insensitive prefix lookup."""
+
+    def __init__(self, table):
+        self.keys = table['key'].to_numpy(dtype=str)
+        self.ids = table['ID'].to_numpy(dtype=object)
+        self.labels = table['label'].to_numpy(dtype=object)
+        self.kinds = table['kind'].to_numpy(dtype=object)
+
+    @classmethod
+    def from_files(cls, tpm_file, annotation_file=None, cache=True):
+        # Built once per TPM table and annotation file and kept in the table cache
+        def read_index(path):
+            return build_index_table(load_tpm_table(path, cache), annotation_file)
+        if not cache:
+            return cls(read_index(tpm_file))
+        extra = [annotation_file] if annotation_file is not None else []
+        return cls(cached_read(tpm_file, read_index, extra_sources=extra))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _range(self, key, prefix=False):
+        lo = np.searchsorted(self.keys, key, side='left')
+        hi = np.searchsorted(self.keys, key + '\uffff' if prefix else key, side='right')
+        return lo, hi
+
+    def exact(self, query):
+        # Gene IDs whose ID, name or alias equals the query (case-insensitive), best match first
+        lo, hi = self._range(query.lower())
+        return list(dict.fromkeys(self.ids[lo:hi]))
+
+    def prefix(self, query, limit=20):
+        # (label, ID, kind) of keys starting with the query, in key order
+        lo, hi = self._range(query.lower(), prefix=True)
+        hi = min(hi, lo + limit) if limit else hi
+        return list(zip(self.labels[lo:hi], self.ids[lo:hi], self.kinds[lo:hi]))
+
+    def resolve(self, query):
+        # Single gene ID for a query, None if unknown. An exact ID wins, then a gene name, then an alias.
+        matches = self.exact(query)
+        return matches[0] if matches else None
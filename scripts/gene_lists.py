@@ -0,0 +1,7 @@
+# Gene lists given on the command line (--genes-file of all scripts)
+
+
+def read_gene_list(path):
+    # One gene ID (or name) per line, '#' starts a comment
+    with open(path) as fh:
+        return [line.split('#')[0].strip() for line in fh if line.split('#')[0].strip()]
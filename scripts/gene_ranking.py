@@ -0,0 +1,170 @@
+import argparse
+import glob
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from combine_pvalues import PATTERN, combine_deseq2
+from design import default_design, oriented_name
+
+# One ranked gene: worst padj and smallest fold change (log2, oriented so that > 0 is the requested direction)
+# over the criteria it passed
+RankedGene = namedtuple('RankedGene', ['gene_id', 'padj', 'log2fc'])
+
+
+class GeneRanking:
+    """padj and log2 fold change of every gene x comparison, filtered and ranked for all genes at once."""
+
+    def __init__(self, gene_ids, comparisons, padj, log2fc, design=default_design):
+        # log2fc is log2(first / second condition of the comparison name), see combine_pvalues.read_deseq2_columns
+        self.gene_ids = np.asarray(gene_ids, dtype=object)
+        self.comparisons = list(comparisons)
+        self.padj = np.asarray(padj, dtype=np.float64)
+        self.log2fc = np.asarray(log2fc, dtype=np.float64)
+        self.design = design
+
+    @classmethod
+    def from_deseq2(cls, paths, gene_ids=None, design=None, workers=None):
+        # Both columns of every DESeq2 table in one read, gene_ids restricts the rows kept (e.g. the store's IDs).
+        # Comparisons are named the way the design names them (reass-swine for deseq2_swine_vs_reass_full.csv).
+        design = design if design is not None else default_design
+        tables = combine_deseq2(paths, ('padj', 'log2FoldChange'), gene_ids, workers, design.comparisons)
+        padj, log2fc = tables['padj'], tables['log2FoldChange']
+        design.check_comparisons(list(padj.columns), 'the DESeq2 tables')
+        return cls(padj.index, padj.columns, padj.to_numpy(), log2fc.to_numpy(), design)
+
+    def criteria(self, comparisons=None, up_in=None, down_in=None):
+        # -> (column positions, signs). Either comparisons as named (+1: up = higher in the first condition, also for
+        # a name in the other orientation than the column), or every comparison of one condition against the others,
+        # oriented so that up = higher in that condition
+        condition = up_in or down_in
+        named = None
+        if comparisons:
+            named = [oriented_name(col, self.comparisons) for col in comparisons]
+            unknown = [col for col, column in zip(comparisons, named) if column not in self.comparisons]
+            if unknown:
+                raise ValueError(f"Unknown comparison(s): {', '.join(sorted(unknown))} (available: {', '.join(self.comparisons)})")
+        if condition is None:
+            if named is None:
+                return np.arange(len(self.comparisons)), np.ones(len(self.comparisons))
+            signs = [1.0 if col == column else -1.0 for col, column in zip(comparisons, named)]
+            return np.array([self.comparisons.index(column) for column in named], dtype=int), np.array(signs)
+        label = self.design.label(condition)
+        if label is None:
+            raise ValueError(f"Unknown condition {condition!r} (available: {', '.join(self.design.labels)})")
+        columns, signs = [], []
+        for i, col in enumerate(self.comparisons):
+            if named and col not in named:
+                continue
+            pair = self.design.comparison(col)
+            if pair is None or label not in pair:
+                continue
+            columns.append(i)
+            signs.append(1.0 if pair[0] == label else -1.0)
+        if not columns:
+            raise ValueError(f"No comparison with {label} among {', '.join(self.comparisons)}")
+        signs = np.array(signs) * (-1.0 if down_in else 1.0)
+        return np.array(columns, dtype=int), signs
+
+    def top(self, n, columns, signs, direction='up', max_padj=0.05, min_log2fc=0.0, combine='all', by='padj'):
+        # Best n genes passing padj <= max_padj and fold change >= min_log2fc in all (or any) of the columns.
+        # direction 'any' ignores the sign. Missing values never pass. All genes are scored in one pass and only
+        # the candidates up to the n-th best primary score are sorted (partition), ties at the cut included so
+        # the gene ID tie-break decides which of them make it.
+        padj = self.padj[:, columns]
+        log2fc = self.log2fc[:, columns] * signs
+        if direction == 'down':
+            log2fc = -log2fc
+        elif direction == 'any':
+            log2fc = np.abs(log2fc)
+        elif direction != 'up':
+            raise ValueError(f"direction must be 'up', 'down' or 'any', not {direction!r}")
+        with np.errstate(invalid='ignore'):
+            passed = (padj <= max_padj) & (log2fc >= min_log2fc)
+
+        if combine == 'all':
+            hits = passed.all(axis=1)
+            worst_padj = padj.max(axis=1)
+            least_log2fc = log2fc.min(axis=1)
+        elif combine == 'any':
+            # scored on the passing comparisons only
+            hits = passed.any(axis=1)
+            worst_padj = np.where(passed, padj, np.inf).min(axis=1)
+            least_log2fc = np.where(passed, log2fc, -np.inf).max(axis=1)
+        else:
+            raise ValueError(f"combine must be 'all' or 'any', not {combine!r}")
+        if by == 'padj':
+            primary, secondary = worst_padj, -least_log2fc
+        elif by == 'log2fc':
+            primary, secondary = -least_log2fc, worst_padj
+        else:
+            raise ValueError(f"by must be 'padj' or 'log2fc', not {by!r}")
+
+        candidates = np.flatnonzero(hits)
+        if n is not None and n < len(candidates):
+            cutoff = np.partition(primary[candidates], n - 1)[n - 1]
+            candidates = candidates[primary[candidates] <= cutoff]
+        order = candidates[np.lexsort((self.gene_ids[candidates], secondary[candidates], primary[candidates]))][:n]
+        return [RankedGene(self.gene_ids[i], worst_padj[i], least_log2fc[i]) for i in order]
+
+
+def deseq2_paths(deseq2_dir):
+    return glob.glob(os.path.join(deseq2_dir, PATTERN))
+
+
+def describe_criteria(ranking, columns, signs, direction, combine):
+    # 'up in reass vs avian, reass vs swine (all)'
+    pairs = [ranking.comparisons[i].split('-') for i in columns]
+    sides = [f'{a} vs {b}' if sign > 0 else f'{b} vs {a}' for (a, b), sign in zip(pairs, signs)]
+    return f"{direction} in {', '.join(sides)} ({combine})"
+
+
+def add_ranking_args(parser, top_default=None):
+    parser.add_argument('--top', type=int, default=top_default, help='number of genes to keep')
+    parser.add_argument('--rank-comparison', action='append', help='comparison to rank on, in either orientation, e.g. reass-swine (repeatable, default: all)')
+    parser.add_argument('--up-in', metavar='CONDITION', help='higher in this condition than in every other one it is compared to, e.g. reass')
+    parser.add_argument('--down-in', metavar='CONDITION', help='lower in this condition than in every other one it is compared to')
+    parser.add_argument('--direction', choices=['up', 'down', 'any'], default='up',
+                        help='sign of log2FoldChange (first vs second condition of the comparison name, or --up-in/--down-in vs the others)')
+    parser.add_argument('--max-padj', type=float, default=0.05)
+    parser.add_argument('--min-log2fc', type=float, default=0.0)
+    parser.add_argument('--combine', choices=['all', 'any'], default='all', help='criteria must hold in all or in any of the comparisons')
+    parser.add_argument('--rank-by', choices=['padj', 'log2fc'], default='padj', help='worst padj or smallest fold change over the comparisons')
+
+
+def rank_genes(args, deseq2_dir, gene_ids=None, design=None):
+    # Ranked genes for the add_ranking_args options, gene_ids restricts the candidates (e.g. genes in the TPM table)
+    if args.up_in and args.down_in:
+        raise ValueError("--up-in and --down-in exclude each other")
+    ranking = GeneRanking.from_deseq2(deseq2_paths(deseq2_dir), gene_ids, design)
+    columns, signs = ranking.criteria(args.rank_comparison, args.up_in, args.down_in)
+    ranked = ranking.top(args.top, columns, signs, args.direction, args.max_padj, args.min_log2fc, args.combine, args.rank_by)
+    print(f"{len(ranked)} genes {describe_criteria(ranking, columns, signs, args.direction, args.combine)}, by {args.rank_by}")
+    return ranked
+
+
+def write_ranking(ranked, out, gene_name=None):
+    # TSV of ID, Name, worst padj, smallest oriented log2 fold change
+    table = pd.DataFrame(ranked, columns=RankedGene._fields).rename(columns={'gene_id': 'ID'})
+    table.insert(1, 'Name', [gene_name(gene_id) if gene_name else '' for gene_id in table['ID']])
+    table.to_csv(out, sep="\t", index=False, float_format='%.4g')
+
+
+if __name__ == '__main__':
+    import contextlib
+    import sys
+    parser = argparse.ArgumentParser(description='Top genes from the DESeq2 tables, e.g. the 15 genes most up-regulated in Reass vs all other viruses.')
+    parser.add_argument('deseq2_dir', help=f'folder with the {PATTERN} files')
+    add_ranking_args(parser, top_default=15)
+    parser.add_argument('--ids-only', action='store_true', help='print only the gene IDs, e.g. for --genes-file')
+    args = parser.parse_args()
+
+    # progress messages to stderr, the ranking is the output
+    with contextlib.redirect_stdout(sys.stderr):
+        ranked = rank_genes(args, args.deseq2_dir)
+    if args.ids_only:
+        print('\n'.join(gene.gene_id for gene in ranked))
+    else:
+        write_ranking(ranked, sys.stdout)
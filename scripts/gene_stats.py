@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+
+from stage_profiler import stage
+
+def box_stats(values, whis=1.5):
+    # values: (genes, conditions, replicates). Same definitions as matplotlib's boxplot_stats,
+    # computed for all genes and conditions at once.
+    q1, med, q3 = np.percentile(values, [25, 50, 75], axis=2)
+    iqr = q3 - q1
+    lo_limit = (q1 - whis * iqr)[..., None]
+    hi_limit = (q3 + whis * iqr)[..., None]
+    # Whiskers end at the most extreme data points within 1.5 IQR, never inside the box
+    whislo = np.minimum(np.where(values >= lo_limit, values, np.inf).min(axis=2), q1)
+    whishi = np.maximum(np.where(values <= hi_limit, values, -np.inf).max(axis=2), q3)
+    return {
+        'q1': q1, 'med': med, 'q3': q3,
+        'whislo': whislo, 'whishi': whishi,
+        'min': values.min(axis=2), 'max': values.max(axis=2),
+    }
+
+
+class GeneStats:
+    """Per-gene, per-condition box statistics and plot scaling for a whole TPM matrix."""
+
+    def __init__(self, gene_ids, values, conditions):
+        self.gene_ids = list(gene_ids)
+        self.conditions = list(conditions)
+        self.values = values
+        self._rows = {gene_id: i for i, gene_id in enumerate(self.gene_ids)}
+
+        self.box = box_stats(values)
+        # explicit width, -1 cannot be inferred for zero genes
+        flat = values.reshape(len(values), int(np.prod(values.shape[1:])))
+        self.y_max = flat.max(axis=1)
+        self.y_min = flat.min(axis=1)
+        self.y_range = self.y_max - self.y_min
+        # Same rules as the single-gene plot: log scale for a >100x spread, brackets start above the data
+        self.use_log_scale = self.y_max / np.maximum(self.y_min, 0.1) > 100
+        self.base_height = np.where(self.use_log_scale, self.y_max * 1.5, self.y_max + 0.05 * self.y_range)
+
+    @classmethod
+    def from_store(cls, store, gene_ids=None, design=None):
+        # Conditions and replicate columns from the store's design unless another one (e.g. without Mock) is given
+        design = design if design is not None else store.design
+        values = store.condition_values(gene_ids, design)
+        return cls(store.tpm_gene_ids() if gene_ids is None else gene_ids, values, design.labels)
+
+    def __contains__(self, gene_id):
+        return gene_id in self._rows
+
+    def row(self, gene_id):
+        i = self._rows[gene_id]
+        return {
+            'values': self.values[i],
+            'box': {key: arr[i] for key, arr in self.box.items()},
+            'y_min': float(self.y_min[i]),
+            'y_max': float(self.y_max[i]),
+            'y_range': float(self.y_range[i]),
+            'use_log_scale': bool(self.use_log_scale[i]),
+            'base_height': float(self.base_height[i]),
+        }
+
+
+def long_form(store, gene_ids, design=None):
+    # Gene/GeneID/Virus/TPM rows for all requested genes in one go (replicates of each condition in order)
+    with stage('long_form'):
+        found = []
+        for gene_id in gene_ids:
+            if gene_id in store:
+                found.append(gene_id)
+            else:
+                print(f"Gene ID '{gene_id}' not found.")
+        design = design if design is not None else store.design
+        values = store.condition_values(found, design)
+        n_cols = values.shape[1] * values.shape[2]
+        virus = np.repeat(design.labels, values.shape[2])
+        names = [store.gene_name(gene_id) for gene_id in found]
+        return pd.DataFrame({
+            'Virus': np.tile(virus, len(found)),
+            'TPM': values.ravel(),
+            'Gene': np.repeat(names, n_cols),
+            'GeneID': np.repeat(found, n_cols),
+        })
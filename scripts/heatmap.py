@@ -0,0 +1,239 @@
+import argparse
+
+import matplotlib
+matplotlib.use('Agg')  # written to files only
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.patches import Patch
+
+from design import Design
+from expression_store import ExpressionStore
+from figure_export import RASTER_DPI, print_file_reports, save_figure
+from stage_profiler import stage
+
+# Exact average linkage up to this many rows (a float64 distance matrix of 2000 rows is 32 MB),
+# larger selections are clustered in two levels (see cluster_order)
+EXACT_LINKAGE_MAX = 2000
+# Gene names on the y axis up to this many rows
+MAX_ROW_LABELS = 60
+
+
+def zscore_log_tpm(values, pseudocount=1.0):
+    # (genes, samples) TPM -> z-score of log2(TPM + pseudocount) per gene, all genes at once.
+    # Genes with the same value in every sample get 0 instead of NaN.
+    logged = np.log2(np.asarray(values, dtype=np.float64) + pseudocount)
+    centered = logged - logged.mean(axis=1, keepdims=True)
+    std = centered.std(axis=1, keepdims=True)
+    return np.divide(centered, std, out=np.zeros_like(centered), where=std > 0).astype(np.float32)
+
+
+def _distances(points):
+    # Euclidean distance matrix from the Gram matrix, diagonal set to inf
+    points = np.asarray(points, dtype=np.float64)
+    sq = (points * points).sum(axis=1)
+    dist = np.sqrt(np.maximum(sq[:, None] + sq[None, :] - 2.0 * points @ points.T, 0.0))
+    np.fill_diagonal(dist, np.inf)
+    return dist
+
+
+def average_linkage_order(points, weights=None):
+    # Leaf order of average-linkage clustering (UPGMA) of the rows, by the nearest-neighbour chain algorithm:
+    # O(n^2) time and memory, every step is one vectorized pass over a row of the distance matrix.
+    # weights: initial cluster sizes (e.g. when the rows are centroids of groups of genes)
+    n = len(points)
+    if n < 3:
+        return np.arange(n)
+    dist = _distances(points)
+    size = np.ones(n) if weights is None else np.asarray(weights, dtype=np.float64).copy()
+    # members[i]: leaf order of the cluster stored at row i
+    members = [[i] for i in range(n)]
+    chain = []
+    remaining = n
+    while remaining > 1:
+        if not chain:
+            chain.append(next(i for i in range(n) if members[i] is not None))
+        a = chain[-1]
+        b = int(np.argmin(dist[a]))
+        # ties go to the previous chain element, otherwise the chain could cycle
+        if len(chain) > 1 and dist[a, chain[-2]] <= dist[a, b]:
+            b = chain[-2]
+        if len(chain) > 1 and b == chain[-2]:
+            chain.pop()
+            chain.pop()
+            # Lance-Williams update for average linkage, the merged cluster lives on in row a
+            merged = (size[a] * dist[a] + size[b] * dist[b]) / (size[a] + size[b])
+            dist[a], dist[:, a] = merged, merged
+            dist[b], dist[:, b] = np.inf, np.inf
+            dist[a, a] = np.inf
+            size[a] += size[b]
+            members[a] = members[a] + members[b]
+            members[b] = None
+            remaining -= 1
+        else:
+            chain.append(b)
+    return np.array(next(m for m in members if m is not None))
+
+
+def _kmeans(points, k, iterations=20, seed=0):
+    # Lloyd's k-means with k-means++ seeding, distances of all points to all centroids in one matrix product
+    rng = np.random.default_rng(seed)
+    points = np.asarray(points, dtype=np.float64)
+    sq = (points * points).sum(axis=1)
+    centroids = [points[rng.integers(len(points))]]
+    closest = np.full(len(points), np.inf)
+    for _ in range(1, k):
+        closest = np.minimum(closest, ((points - centroids[-1]) ** 2).sum(axis=1))
+        total = closest.sum()
+        centroids.append(points[rng.choice(len(points), p=closest / total)] if total > 0 else points[rng.integers(len(points))])
+    centroids = np.array(centroids)
+    labels = None
+    for _ in range(iterations):
+        d = sq[:, None] - 2.0 * points @ centroids.T + (centroids * centroids).sum(axis=1)[None, :]
+        new_labels = d.argmin(axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, points)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return labels, centroids, np.bincount(labels, minlength=k)
+
+
+def cluster_order(points, exact_max=EXACT_LINKAGE_MAX):
+    # Row order for the heatmap. Exact average linkage up to exact_max rows; above that the rows are grouped by
+    # k-means, the groups ordered by average linkage of their centroids (weighted by size) and each group ordered
+    # the same way recursively, so similar genes end up next to each other in seconds for 10k+ genes.
+    points = np.asarray(points)
+    n = len(points)
+    if n <= exact_max:
+        return average_linkage_order(points)
+    k = min(exact_max // 4, max(2, n // 20))
+    labels, centroids, counts = _kmeans(points, k)
+    used = np.flatnonzero(counts)
+    if len(used) < 2:
+        # all rows identical as far as k-means can tell, keep them as they are
+        return np.arange(n)
+    order = []
+    for group in used[average_linkage_order(centroids[used], counts[used])]:
+        rows = np.flatnonzero(labels == group)
+        order.append(rows[cluster_order(points[rows], exact_max)])
+    return np.concatenate(order)
+
+
+def heatmap_matrix(store, gene_ids, design=None, cluster=True):
+    # -> (z-scores (genes, samples) in row order, gene IDs in row order, sample labels, condition of each sample)
+    design = design if design is not None else store.design
+    found = [gene_id for gene_id in gene_ids if gene_id in store]
+    if len(found) < len(gene_ids):
+        print(f"{len(gene_ids) - len(found)} gene IDs not found in the tables")
+    with stage('zscore'):
+        values = store.condition_values(found, design)
+        n_genes, n_conditions, n_reps = values.shape
+        zscores = zscore_log_tpm(values.reshape(n_genes, n_conditions * n_reps))
+    if cluster and n_genes > 2:
+        with stage('cluster'):
+            order = cluster_order(zscores)
+        zscores = zscores[order]
+        found = [found[i] for i in order]
+    samples = [col for cols in design.replicate_columns(store.tpm_columns).values() for col in cols]
+    conditions = list(np.repeat(design.labels, n_reps))
+    return zscores, found, samples, conditions
+
+
+def draw_heatmap(store, zscores, gene_ids, samples, conditions, design, vmax=2.5, title=None):
+    # One image for all genes (rasterized in PDF/SVG whatever the number of rows) under a condition color bar
+    # in the boxplot colors, separators between the conditions
+    n_genes = len(gene_ids)
+    height = 3.0 + (0.14 * n_genes if n_genes <= MAX_ROW_LABELS else 6.0)
+    fig = Figure(figsize=(max(5.0, 0.45 * len(samples) + 2.5), height))
+    FigureCanvasAgg(fig)
+    grid = fig.add_gridspec(2, 2, height_ratios=[0.25, height - 2.25], width_ratios=[1, 0.04], hspace=0.03, wspace=0.04)
+    ax_bar = fig.add_subplot(grid[0, 0])
+    ax = fig.add_subplot(grid[1, 0], sharex=ax_bar)
+    ax_scale = fig.add_subplot(grid[1, 1])
+
+    colors = np.array([design.palette[cond] for cond in conditions])[None, :, :]
+    ax_bar.imshow(colors, aspect='auto', interpolation='nearest')
+    ax_bar.set_yticks([])
+    ax_bar.tick_params(axis='x', bottom=False, labelbottom=False)
+    image = ax.imshow(zscores, aspect='auto', interpolation='nearest', cmap='RdBu_r', vmin=-vmax, vmax=vmax, rasterized=True)
+    for i in range(1, len(conditions)):
+        if conditions[i] != conditions[i - 1]:
+            for axis in (ax, ax_bar):
+                axis.axvline(i - 0.5, color='white', linewidth=1.5)
+    ax.set_xticks(range(len(samples)), samples, rotation=90, fontsize=8)
+    if n_genes <= MAX_ROW_LABELS:
+        ax.set_yticks(range(n_genes), [store.gene_name(gene_id) for gene_id in gene_ids], fontsize=7)
+    else:
+        ax.set_yticks([])
+        ax.set_ylabel(f'{n_genes} genes')
+
+    fig.colorbar(image, cax=ax_scale, label='z-score of log2(TPM + 1)')
+    handles = [Patch(facecolor=design.palette[label], edgecolor='grey', label=label) for label in design.labels]
+    ax_bar.legend(handles=handles, loc='lower left', bbox_to_anchor=(0, 1.05), ncol=len(handles), frameon=False, fontsize=8)
+    if title:
+        fig.suptitle(title)
+    width, fig_height = fig.get_size_inches()
+    fig.subplots_adjust(left=1.2 / width if n_genes <= MAX_ROW_LABELS else 0.4 / width, right=1 - 0.9 / width,
+                        bottom=1.1 / fig_height, top=1 - 0.7 / fig_height)
+    return fig
+
+
+def plot_heatmap(store, gene_ids, output_base='heatmap', formats=('pdf', 'png'), design=None, cluster=True, vmax=2.5,
+                 raster_dpi=RASTER_DPI, report=False, title=None):
+    # Heatmap of log-TPM z-scores of the genes across all replicate samples, rows clustered unless cluster=False.
+    # Returns the gene IDs in row order.
+    design = design if design is not None else store.design
+    zscores, ordered, samples, conditions = heatmap_matrix(store, gene_ids, design, cluster)
+    if not ordered:
+        return []
+    with stage('draw_heatmap'):
+        fig = draw_heatmap(store, zscores, ordered, samples, conditions, design, vmax, title)
+    reports = [save_figure(fig, f'{output_base}.{fmt}', fmt, raster_dpi=raster_dpi) for fmt in formats]
+    if report:
+        print_file_reports(reports)
+    return ordered
+
+
+def significant_genes(store, level='*'):
+    # Genes with at least one comparison at the level or better, in p-value table order
+    from comparisons import star_labels
+    table = store.significance()
+    hits = (table.categories <= star_labels.index(level)).any(axis=1)
+    return [gene_id for gene_id in np.asarray(store.pval_gene_ids())[hits].tolist() if gene_id in store]
+
+
+if __name__ == '__main__':
+    import time
+    parser = argparse.ArgumentParser(description='Clustered heatmap of log-TPM z-scores for many genes across all samples.')
+    parser.add_argument('tpm_file')
+    parser.add_argument('pval_file')
+    parser.add_argument('--genes', nargs='+', help='gene IDs (default: all genes with a significant comparison)')
+    parser.add_argument('--genes-file', help='file with one gene ID per line')
+    parser.add_argument('--level', choices=['***', '**', '*'], default='*', help='significance of the default gene selection')
+    parser.add_argument('--output', default='heatmap', help='output file base name')
+    parser.add_argument('--formats', nargs='+', default=['pdf', 'png'], choices=['pdf', 'png', 'svg'])
+    parser.add_argument('--no-cluster', action='store_true', help='keep the genes in the given order')
+    parser.add_argument('--vmax', type=float, default=2.5, help='z-score at the ends of the color scale')
+    parser.add_argument('--raster-dpi', type=int, default=RASTER_DPI, help='resolution of the heatmap image in pdf/svg')
+    parser.add_argument('--order-file', help='write the gene IDs in row order to this file')
+    parser.add_argument('--design', help='conditions, replicate columns, colors and comparisons as JSON (default: mock/avian/swine/reass)')
+    args = parser.parse_args()
+
+    store = ExpressionStore.from_files(args.tpm_file, args.pval_file, design=Design.from_json(args.design) if args.design else None)
+    gene_ids = list(args.genes or [])
+    if args.genes_file:
+        from gene_lists import read_gene_list
+        gene_ids += read_gene_list(args.genes_file)
+    if not gene_ids:
+        gene_ids = significant_genes(store, args.level)
+    start = time.perf_counter()
+    ordered = plot_heatmap(store, gene_ids, args.output, args.formats, cluster=not args.no_cluster, vmax=args.vmax,
+                           raster_dpi=args.raster_dpi, report=True)
+    print(f"{len(ordered)} genes in {time.perf_counter() - start:.2f} s")
+    if args.order_file:
+        with open(args.order_file, 'w') as fh:
+            fh.write(''.join(f'{gene_id}\n' for gene_id in ordered))
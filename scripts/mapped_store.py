@@ -0,0 +1,171 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from comparisons import ComparisonSchema, SignificanceTable, classify_pvals
+from design import default_design
+from stage_profiler import stage
+from table_cache import cache_entry, write_entry
+
+# The TPM and p-value tables as plain .npy arrays in the table cache, memory-mapped read-only by every process
+# that opens them: worker processes share the page cache instead of each holding its own pandas copy,
+# and a gene's TPM row is a slice of the mapped matrix.
+MAPPED_VERSION = 2
+
+
+class RowIndex:
+    """Gene ID -> row lookup by binary search over the sorted IDs, two arrays that can be memory-mapped."""
+
+    def __init__(self, keys, rows):
+        self.keys = keys
+        self.rows = rows
+
+    @classmethod
+    def build(cls, ids):
+        ids = np.asarray(ids, dtype=str)
+        order = np.argsort(ids, kind='stable')
+        return cls(ids[order], order.astype(np.int64))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_indexer(self, gene_ids):
+        # Rows of all queried IDs at once, -1 for unknown ones
+        query = np.asarray(gene_ids, dtype=str)
+        if len(self.keys) == 0:
+            return np.full(query.shape, -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        return np.where(self.keys[pos] == query, self.rows[pos], -1)
+
+    def __contains__(self, gene_id):
+        return self.get_indexer([gene_id])[0] >= 0
+
+    def __getitem__(self, gene_id):
+        row = self.get_indexer([gene_id])[0]
+        if row < 0:
+            raise KeyError(gene_id)
+        return int(row)
+
+
+def save_mapped_tables(store, folder):
+    # Arrays of an ExpressionStore in the layout MappedStore opens
+    tpm = store.tpm
+    pvals = store.pvals
+    np.save(os.path.join(folder, 'tpm.npy'), np.ascontiguousarray(tpm[store.tpm_columns].to_numpy(dtype=np.float32)))
+    np.save(os.path.join(folder, 'pvals.npy'), np.ascontiguousarray(pvals.to_numpy(dtype=np.float64)))
+    # star category of every p-value, so no process has to classify (and hold) the whole table
+    np.save(os.path.join(folder, 'categories.npy'), classify_pvals(pvals.to_numpy(dtype=np.float64)).astype(np.int8))
+    tpm_index = RowIndex.build(tpm.index.astype(str))
+    pval_index = RowIndex.build(pvals.index.astype(str))
+    np.save(os.path.join(folder, 'tpm_keys.npy'), tpm_index.keys)
+    np.save(os.path.join(folder, 'tpm_rows.npy'), tpm_index.rows)
+    np.save(os.path.join(folder, 'pval_ids.npy'), pvals.index.to_numpy(dtype=str))
+    np.save(os.path.join(folder, 'pval_keys.npy'), pval_index.keys)
+    np.save(os.path.join(folder, 'pval_rows.npy'), pval_index.rows)
+    if 'Name' in tpm.columns:
+        names = tpm['Name'].astype(object).where(tpm['Name'].notna(), '').astype(str)
+    else:
+        names = pd.Series('', index=tpm.index)
+    np.save(os.path.join(folder, 'names.npy'), names.to_numpy(dtype=str))
+    with open(os.path.join(folder, 'meta.json'), 'w') as fh:
+        json.dump({'version': MAPPED_VERSION, 'tpm_columns': store.tpm_columns, 'pval_columns': store.pval_columns}, fh)
+
+
+class MappedStore:
+    """ExpressionStore stand-in backed by memory-mapped arrays, shared by all processes that open the same entry."""
+
+    def __init__(self, entry, design=None):
+        self.entry = entry
+        with open(os.path.join(entry, 'meta.json')) as fh:
+            meta = json.load(fh)
+        if meta.get('version') != MAPPED_VERSION:
+            raise ValueError(f"{entry}: mapped tables version {meta.get('version')}, expected {MAPPED_VERSION}")
+
+        def load(name):
+            return np.load(os.path.join(entry, name), mmap_mode='r')
+
+        self.tpm_columns = meta['tpm_columns']
+        self.pval_columns = meta['pval_columns']
+        self.tpm = load('tpm.npy')
+        self.pvals = load('pvals.npy')
+        self.categories = load('categories.npy')
+        self.names = load('names.npy')
+        self.pval_ids = load('pval_ids.npy')
+        self.tpm_index = RowIndex(load('tpm_keys.npy'), load('tpm_rows.npy'))
+        self.pval_index = RowIndex(load('pval_keys.npy'), load('pval_rows.npy'))
+        self._tpm_positions = {col: i for i, col in enumerate(self.tpm_columns)}
+        self.design = design if design is not None else default_design
+        self._significance = None
+
+    @classmethod
+    def from_files(cls, tpm_file, pval_file, cache=True, design=None, cache_dir=None):
+        # Written once per pair of source files (rebuilt when either changes), then only opened
+        entry = mapped_entry(tpm_file, pval_file, cache_dir)
+        if not os.path.isfile(os.path.join(entry, 'meta.json')):
+            from expression_store import ExpressionStore
+            store = ExpressionStore.from_files(tpm_file, pval_file, cache)
+            with stage('write_mapped'):
+                write_entry(entry, lambda folder: save_mapped_tables(store, folder))
+        return cls(entry, design)
+
+    def __contains__(self, gene_id):
+        return gene_id in self.tpm_index and gene_id in self.pval_index
+
+    def gene_ids(self):
+        # IDs present in both tables, in p-value table order
+        ids = np.asarray(self.pval_ids)
+        return ids[self.tpm_index.get_indexer(ids) >= 0].tolist()
+
+    def tpm_gene_ids(self):
+        ids = np.empty(len(self.tpm_index), dtype=self.tpm_index.keys.dtype)
+        ids[self.tpm_index.rows] = self.tpm_index.keys
+        return ids.tolist()
+
+    def pval_gene_ids(self):
+        # All IDs of the p-value table, in table order (the rows of significance())
+        return self.pval_ids
+
+    def gene_name(self, gene_id):
+        # Get gene name or fallback to ID
+        name = str(self.names[self.tpm_index[gene_id]])
+        return name if name.strip() else gene_id
+
+    def tpm_row(self, gene_id):
+        # All replicate columns of one gene, a read-only view into the mapped matrix (no copy)
+        return self.tpm[self.tpm_index[gene_id]]
+
+    def tpm_values(self, gene_id, columns):
+        return np.asarray(self.tpm_row(gene_id)[[self._tpm_positions[col] for col in columns]], dtype=np.float32)
+
+    def pval_row(self, gene_id):
+        return pd.Series(self.pvals[self.pval_index[gene_id]], index=self.pval_columns)
+
+    def tpm_matrix(self):
+        return self.tpm
+
+    def condition_values(self, gene_ids=None, design=None):
+        # (genes, conditions, replicates) TPM array, same single take as ExpressionStore.condition_values.
+        # A copy of the requested rows: without gene_ids that is the whole table, so workers ask per gene or chunk.
+        index = (design if design is not None else self.design).column_index(self.tpm_columns)
+        if gene_ids is None:
+            return self.tpm[:, index]
+        rows = self.tpm_index.get_indexer(gene_ids)
+        if (rows < 0).any():
+            missing = [gene_id for gene_id, row in zip(gene_ids, rows) if row < 0]
+            raise KeyError(f"Gene ID(s) not in the TPM table: {', '.join(map(str, missing[:5]))}")
+        return self.tpm[rows[:, None, None], index]
+
+    def significance(self):
+        # Reads the mapped p-values and precomputed categories row by row, rows looked up in the shared index
+        if self._significance is None:
+            schema = ComparisonSchema(self.pval_columns, self.design)
+            self._significance = SignificanceTable(self.pval_ids, self.pvals, schema, rows=self.pval_index, categories=self.categories)
+        return self._significance
+
+
+def mapped_entry(tpm_file, pval_file, cache_dir=None):
+    # Cache folder of the mapped tables, keyed by both source files
+    # (the layout version is part of the name, entries of an older layout are rebuilt and dropped)
+    return cache_entry(tpm_file, save_mapped_tables, cache_dir, extra_sources=[pval_file]) + f'-v{MAPPED_VERSION}'
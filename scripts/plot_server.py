@@ -0,0 +1,294 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import traceback
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import matplotlib
+matplotlib.use('Agg')  # the server never opens windows
+import numpy as np
+
+import render_workers
+
+from design import Design
+from gene_index import GeneIndex
+from gene_stats import GeneStats
+from render_workers import DEFAULT_PORT, add_server_args
+from stage_profiler import stage, traced_gene
+from summary_grid import draw_grid_page
+
+# Local plot service: the tables are loaded once, plots are rendered by a pool of worker processes straight into
+# memory and kept in an LRU cache of bytes. Binds to localhost and needs no network access.
+#
+# python scripts/plot_server.py input-data/tpms-human.tsv input-data/pvals-virus-comparisons.tsv --workers 4
+# curl -o MX1.png localhost:8765/gene/MX1
+# curl -o MX1.svg 'localhost:8765/gene/ENSG00000157601?format=svg'
+# curl -o panel.png -d '{"genes": ["IFNL1", "IFNL2", "IFNL3", "MX1"], "ncols": 2}' localhost:8765/panel
+
+CONTENT_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml', 'pdf': 'application/pdf'}
+# PNG resolution like the files of plot_tpm_boxplot, ?dpi= within the bounds
+DEFAULT_DPI = 300
+DPI_RANGE = (30, 600)
+MAX_PANEL_GENES = 48
+# A render that takes longer than this is reported as failed (the worker keeps going)
+RENDER_TIMEOUT = 120
+
+def _figure_bytes(fig, fmt, dpi):
+    buf = io.BytesIO()
+    with stage(f'savefig_{fmt}'):
+        fig.savefig(buf, format=fmt, dpi=dpi if fmt == 'png' else 'figure')
+    return buf.getvalue()
+
+
+def _render_gene(gene_id, fmt, dpi):
+    # Same jitter on every render, so a plot looks the same whether it came from the cache or not
+    np.random.seed(0)
+    try:
+        with traced_gene(gene_id):
+            # box statistics of this gene only, no worker holds them for the whole table
+            render_workers.template.draw(render_workers.store, gene_id, None, render_workers.backend)
+            return _figure_bytes(render_workers.template.fig, fmt, dpi)
+    except Exception:
+        render_workers.template.reset()
+        raise
+
+
+def _render_panel(gene_ids, fmt, dpi, ncols, sharey):
+    np.random.seed(0)
+    nrows = -(-len(gene_ids) // ncols)
+    with stage('gene_stats'):
+        stats = GeneStats.from_store(render_workers.store, gene_ids)
+    fig = draw_grid_page(render_workers.store, stats, gene_ids, ncols, nrows, sharey)
+    return _figure_bytes(fig, fmt, dpi)
+
+
+class ByteCache:
+    """Rendered plots by key, least recently used ones evicted once the total size exceeds the budget."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        # Plots larger than the whole budget are served but not kept
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            self._entries[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class PlotService:
+    """Gene lookup, cache and worker pool behind the HTTP handler."""
+
+    def __init__(self, store, index, tpm_file, pval_file, workers=None, cache_mb=256, mapped=False, backend='seaborn'):
+        self.store = store
+        self.index = index
+        self.cache = ByteCache(int(cache_mb * 1024 * 1024))
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = multiprocessing.Pool(self.workers, initializer=render_workers.init_worker,
+                                          initargs=(tpm_file, pval_file, store.design, mapped, backend))
+        # Concurrent requests for a plot that is being rendered wait for that render instead of starting another
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_files(cls, tpm_file, pval_file, workers=None, cache_mb=256, design=None, mapped=False, backend='seaborn', annotation=None):
+        # with mapped=True this writes the .table-cache entry the workers then only open
+        store = render_workers.open_store(tpm_file, pval_file, design, mapped)
+        index = GeneIndex.from_files(tpm_file, annotation)
+        return cls(store, index, tpm_file, pval_file, workers, cache_mb, mapped, backend)
+
+    def resolve(self, query):
+        # Gene ID for an ID, name or alias, LookupError with suggestions if it is not in both tables
+        gene_id = self.index.resolve(query)
+        if gene_id is None or gene_id not in self.store:
+            matches = self.index.prefix(query, limit=5)
+            hint = f" Did you mean: {', '.join(f'{label} ({match})' for label, match, _ in matches)}?" if matches else ""
+            raise LookupError(f"Gene '{query}' not found.{hint}")
+        return gene_id
+
+    def gene_plot(self, query, fmt='png', dpi=DEFAULT_DPI):
+        # -> (bytes, gene ID, True if served from the cache)
+        fmt, dpi = check_format(fmt, dpi)
+        gene_id = self.resolve(query)
+        data, cached = self._get(('gene', gene_id, fmt, dpi), _render_gene, (gene_id, fmt, dpi))
+        return data, gene_id, cached
+
+    def panel_plot(self, queries, fmt='png', dpi=DEFAULT_DPI, ncols=4, sharey=False):
+        # -> (bytes, gene IDs, True if served from the cache); unknown genes fail the whole panel
+        fmt, dpi = check_format(fmt, dpi)
+        if not queries or len(queries) > MAX_PANEL_GENES:
+            raise ValueError(f"A panel needs 1 to {MAX_PANEL_GENES} genes, got {len(queries)}")
+        gene_ids = list(dict.fromkeys(self.resolve(query) for query in queries))
+        ncols = max(1, min(int(ncols), len(gene_ids)))
+        key = ('panel', tuple(gene_ids), fmt, dpi, ncols, bool(sharey))
+        data, cached = self._get(key, _render_panel, (gene_ids, fmt, dpi, ncols, bool(sharey)))
+        return data, gene_ids, cached
+
+    def _get(self, key, func, args):
+        data = self.cache.get(key)
+        if data is not None:
+            return data, True
+        with self._lock:
+            pending = self._inflight.get(key)
+            if pending is None:
+                pending = self._inflight[key] = self._pool.apply_async(func, args)
+        try:
+            data = pending.get(RENDER_TIMEOUT)
+        finally:
+            with self._lock:
+                if self._inflight.get(key) is pending:
+                    del self._inflight[key]
+        self.cache.put(key, data)
+        return data, False
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+def check_format(fmt, dpi):
+    if fmt not in CONTENT_TYPES:
+        raise ValueError(f"format must be one of {', '.join(CONTENT_TYPES)}, not {fmt!r}")
+    dpi = int(dpi)
+    if not DPI_RANGE[0] <= dpi <= DPI_RANGE[1]:
+        raise ValueError(f"dpi must be between {DPI_RANGE[0]} and {DPI_RANGE[1]}")
+    return fmt, dpi
+
+
+class PlotRequestHandler(BaseHTTPRequestHandler):
+    """GET /gene/<id-or-name>, POST /panel and GET /stats."""
+
+    server_version = 'rnaseq-boxplots'
+    quiet = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path.startswith('/gene/'):
+            self._respond(lambda service: service.gene_plot(unquote(url.path[len('/gene/'):]), query.get('format', 'png'),
+                                                            query.get('dpi', DEFAULT_DPI)),
+                          query.get('format', 'png'))
+        elif url.path == '/stats':
+            service = self.server.service
+            self._send(200, 'application/json', json.dumps({'workers': service.workers, 'cache': service.cache.stats()}).encode())
+        else:
+            self._error(404, f"Unknown path {url.path} (GET /gene/<id-or-name>, POST /panel, GET /stats)")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/panel':
+            self._error(404, f"Unknown path {url.path} (POST /panel)")
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            genes = body['genes']
+            if not isinstance(genes, list):
+                raise ValueError("genes must be a list")
+        except (ValueError, KeyError, TypeError) as e:
+            self._error(400, f'Expected {{"genes": [...], "format": "png", "dpi": 300, "ncols": 4, "sharey": false}}: {e!r}')
+            return
+        fmt = body.get('format', 'png')
+        self._respond(lambda service: service.panel_plot(genes, fmt, body.get('dpi', DEFAULT_DPI), body.get('ncols', 4),
+                                                         body.get('sharey', False)), fmt)
+
+    def _respond(self, render, fmt):
+        try:
+            data, genes, cached = render(self.server.service)
+        except LookupError as e:
+            self._error(404, str(e))
+        except ValueError as e:
+            self._error(400, str(e))
+        except multiprocessing.TimeoutError:
+            self._error(504, f"Rendering took longer than {RENDER_TIMEOUT} s")
+        except Exception:
+            self._error(500, traceback.format_exc())
+        else:
+            genes = genes if isinstance(genes, list) else [genes]
+            self._send(200, CONTENT_TYPES[fmt], data, {'X-Cache': 'hit' if cached else 'miss', 'X-Genes': ','.join(genes)})
+
+    def _send(self, status, content_type, data, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, message):
+        self._send(status, 'application/json', json.dumps({'error': message}).encode())
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(service, host='127.0.0.1', port=DEFAULT_PORT, quiet=True):
+    # One thread per connection, the renders themselves run in the service's worker processes
+    handler = type('Handler', (PlotRequestHandler,), {'quiet': quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(service, host='127.0.0.1', port=DEFAULT_PORT, quiet=True):
+    server = make_server(service, host, port, quiet)
+    print(f"Serving plots on http://{host}:{server.server_address[1]} with {service.workers} worker(s), "
+          f"{service.cache.max_bytes / 1024**2:.0f} MB cache (Ctrl-C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local HTTP server for single-gene boxplots and panels, tables loaded once.')
+    parser.add_argument('tpm_file')
+    parser.add_argument('pval_file')
+    parser.add_argument('--annotation', help='extra gene names and aliases (ID/Name/Aliases TSV, e.g. input-data/gene-aliases.tsv)')
+    parser.add_argument('--design', help='conditions, replicate columns, colors and comparisons as JSON (default: mock/avian/swine/reass)')
+    add_server_args(parser)
+    args = parser.parse_args()
+
+    service = PlotService.from_files(args.tpm_file, args.pval_file, args.workers, args.cache_mb,
+                                     Design.from_json(args.design) if args.design else None, args.mmap, args.backend, args.annotation)
+    serve(service, args.host, args.port, quiet=not args.verbose)
+    sys.exit(0)
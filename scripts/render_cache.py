@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+MANIFEST_FILE = 'boxplot-manifest.json'
+
+
+def render_key(store, gene_id, params):
+    # Hash of everything that ends up in the plot: the gene's TPM and p-value rows and the plot settings
+    h = hashlib.sha1()
+    h.update(gene_id.encode())
+    h.update(store.gene_name(gene_id).encode())
+    h.update('\t'.join(store.tpm_columns).encode())
+    h.update(np.ascontiguousarray(store.tpm_values(gene_id, store.tpm_columns)).tobytes())
+    pvals = store.pval_row(gene_id)
+    h.update('\t'.join(pvals.index).encode())
+    h.update(pvals.to_numpy(dtype=np.float64).tobytes())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class RenderManifest:
+    """Per-gene record of what was rendered into which files, to skip unchanged genes on reruns."""
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as fh:
+                self.entries = json.load(fh)
+
+    def _files(self, filename_base, params):
+        # Same directory as the manifest, like plot_tpm_boxplot writes into the working directory
+        folder = os.path.dirname(self.path)
+        return {fmt: os.path.join(folder, f'boxplot.{filename_base}.{fmt}') for fmt in params['formats']}
+
+    def is_current(self, store, gene_id, filename_base, params):
+        entry = self.entries.get(gene_id)
+        if entry is None or entry['key'] != render_key(store, gene_id, params) or entry.get('files') is None:
+            return False
+        # The files must still be the ones we wrote (not deleted, replaced or edited by hand)
+        for fmt, path in self._files(filename_base, params).items():
+            recorded = entry['files'].get(fmt)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+            if recorded is None or [stat.st_size, stat.st_mtime_ns] != recorded:
+                return False
+        return True
+
+    def stale(self, store, gene_ids, basename, params):
+        return [gene_id for gene_id in gene_ids if gene_id not in store or not self.is_current(store, gene_id, basename(store, gene_id), params)]
+
+    def record(self, store, gene_id, filename_base, params):
+        # File stats are taken in save(), after background writers have finished
+        self.entries[gene_id] = {
+            'key': render_key(store, gene_id, params),
+            'files': None,
+            'pending': self._files(filename_base, params),
+        }
+
+    def discard(self, gene_id):
+        # e.g. a background write of the gene's files failed
+        self.entries.pop(gene_id, None)
+
+    def save(self):
+        for gene_id, entry in list(self.entries.items()):
+            pending = entry.pop('pending', None)
+            if pending is None:
+                continue
+            try:
+                entry['files'] = {fmt: [os.stat(path).st_size, os.stat(path).st_mtime_ns] for fmt, path in pending.items()}
+            except OSError:
+                del self.entries[gene_id]  # not (fully) written, render again next time
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w') as fh:
+            json.dump(self.entries, fh, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -0,0 +1,45 @@
+from expression_store import ExpressionStore
+from mapped_store import MappedStore
+
+# Setup shared by the render worker pools of batch_render.py and plot_server.py: the table store, a reusable
+# single-gene figure and (for batch runs) the file writers, set up once per process by init_worker.
+# matplotlib is only imported when a worker starts, so parsers and store helpers load without it.
+
+DEFAULT_PORT = 8765
+
+# Per-worker state, set by init_worker
+store = None
+template = None
+exporter = None
+backend = 'seaborn'
+
+
+def open_store(tpm_file, pval_file, design=None, mapped=False, cache=True):
+    # mapped: all processes read the same memory-mapped arrays in .table-cache instead of each parsing its own copy
+    if mapped:
+        return MappedStore.from_files(tpm_file, pval_file, design=design)
+    return ExpressionStore.from_files(tpm_file, pval_file, cache=cache, design=design)
+
+
+def init_worker(tpm_file, pval_file, design=None, mapped=False, plot_backend='seaborn', max_rss_mb=None, formats=None):
+    # Pool initializer. No box statistics for the whole table here: they are computed per chunk or request
+    # from the rows being drawn, so no worker holds a copy of the table. formats: FigureExporter for batch runs.
+    global store, template, exporter, backend
+    from tpm_boxplot import BoxplotTemplate
+    backend = plot_backend
+    store = open_store(tpm_file, pval_file, design, mapped)
+    template = BoxplotTemplate(max_rss_mb=max_rss_mb, design=store.design)
+    if formats is not None:
+        from figure_export import FigureExporter
+        exporter = FigureExporter(formats)
+
+
+def add_server_args(parser):
+    # Options of plot_server.py, also used by rnaseq-boxplots.py serve
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: this machine only)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--workers', type=int, default=None, help='render processes (default: all cores)')
+    parser.add_argument('--cache-mb', type=float, default=256, help='memory for rendered plots, least recently used ones are dropped first')
+    parser.add_argument('--backend', choices=['seaborn', 'matplotlib'], default='seaborn')
+    parser.add_argument('--mmap', action='store_true', help='share one memory-mapped copy of the tables between the workers')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
@@ -0,0 +1,134 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# featureCounts output with an added TPM column, one file per sample (<condition>_rep<N>.counts.tpm.tsv):
+# Geneid, Chr, Start, End, Strand, Length, count, TPM
+COUNT_COLUMNS = ['Geneid', 'Chr', 'Start', 'End', 'Strand', 'Length', 'count', 'TPM']
+SUFFIX = '.counts.tpm.tsv'
+# Host genes counted in the same run, left out of the segment table
+HOST_PREFIX = 'ENSG'
+
+# Data rules, both off unless asked for (the DESeq2 p-value tables use the IDs as counted):
+# strand of the feature -> prefix of the segment ID (vRNA on +, mRNA on - with --strand 2 counting)
+STRAND_PREFIX = {'+': 'vRNA', '-': 'mRNA'}
+# segment names as counted -> names in the paper
+SEGMENT_RENAMES = {'N1': 'NA', 'M1': 'MP', 'NS1': 'NS'}
+
+
+def sample_name(path):
+    # avian_rep1.counts.tpm.tsv -> avian-rep1, reassortant_rep2... -> reass-rep2 (column names of the TPM tables)
+    return os.path.basename(path)[:-len(SUFFIX)].replace('_', '-').replace('reassortant', 'reass')
+
+
+def recompute_tpm(counts, lengths):
+    # TPM from counts and feature lengths, for one sample or a (features, samples) matrix at once
+    counts = np.asarray(counts, dtype=np.float64)
+    rates = counts.reshape(len(counts), -1) / np.asarray(lengths, dtype=np.float64).reshape(-1, 1)
+    total = rates.sum(axis=0)
+    tpm = np.divide(rates, total, out=np.zeros_like(rates), where=total > 0) * 1e6
+    return tpm.reshape(counts.shape)
+
+
+def segment_id(geneid, strand, split_strands=False, renames=None):
+    # gene-N1 -> gene-NA with renames, gene-vRNA-HA / gene-mRNA-HA from the strand with split_strands
+    segment = geneid[len('gene-'):] if geneid.startswith('gene-') else geneid
+    strand_prefix = None
+    for prefix in STRAND_PREFIX.values():
+        if segment.startswith(f'{prefix}-'):
+            strand_prefix, segment = prefix, segment[len(prefix) + 1:]
+    if renames:
+        segment = renames.get(segment, segment)
+    if split_strands:
+        strand_prefix = STRAND_PREFIX[strand]
+    return f'gene-{strand_prefix}-{segment}' if strand_prefix else f'gene-{segment}'
+
+
+def read_sample_counts(path, value='TPM', split_strands=False, renames=None):
+    # -> Series segment ID -> value ('TPM' as in the file, 'count', or 'recomputed' TPM over all features of the file)
+    with open(path) as fh:
+        has_header = fh.readline().startswith('Geneid')
+    df = pd.read_csv(path, sep="\t", header=None, names=COUNT_COLUMNS, skiprows=1 if has_header else 0,
+                     usecols=['Geneid', 'Strand', 'Length', 'count', 'TPM'], dtype={'Geneid': str, 'Strand': str},
+                     float_precision='round_trip')  # written back digit for digit like the Ruby scripts did
+    if value == 'recomputed':
+        # before the host genes are dropped, so the library size is the same as for the TPM column
+        values = recompute_tpm(df['count'].to_numpy(), df['Length'].to_numpy())
+    elif value in ('TPM', 'count'):
+        values = df[value].to_numpy(dtype=np.float64)
+    else:
+        raise ValueError(f"value must be 'TPM', 'count' or 'recomputed', not {value!r}")
+    keep = ~df['Geneid'].str.startswith(HOST_PREFIX).to_numpy()
+    ids = [segment_id(geneid, strand, split_strands, renames) for geneid, strand in zip(df['Geneid'][keep], df['Strand'][keep])]
+    series = pd.Series(values[keep], index=ids, name=sample_name(path))
+    if series.index.has_duplicates:
+        raise ValueError(f"{path}: segment IDs are not unique after the strand/rename rules")
+    return series
+
+
+def combine_segment_counts(input_dir, value='TPM', split_strands=False, renames=None, workers=None):
+    # Segment x sample table (ID, Name, <condition>-rep<N>, ...) from all per-sample files of a folder,
+    # read in parallel. Replaces combine-counts-segments*.rb (segments sorted by name, samples by column name).
+    paths = sorted(glob.glob(os.path.join(input_dir, f'*{SUFFIX}')))
+    if not paths:
+        raise FileNotFoundError(f"No *{SUFFIX} files in {input_dir}")
+    with ThreadPoolExecutor(max_workers=workers or min(len(paths), os.cpu_count() or 1)) as pool:
+        samples = list(pool.map(lambda path: read_sample_counts(path, value, split_strands, renames), paths))
+    samples.sort(key=lambda series: series.name)
+
+    merged = pd.concat(samples, axis=1, join='outer')
+    merged.index = merged.index.astype(str)
+    merged = merged.sort_index()
+    for series in samples:
+        n_missing = len(merged) - len(series)
+        if n_missing:
+            print(f"{n_missing} segments have no value for {series.name}")
+    merged.index.name = 'ID'
+    merged.insert(0, 'Name', pd.Series(merged.index.str[len('gene-'):], index=merged.index).astype('category'))
+    print(f"{len(merged)} segments from {len(samples)} samples in {input_dir}")
+    return merged.reset_index()
+
+
+def segment_store(input_dir, pval_file, value='TPM', split_strands=False, renames=None, design=None):
+    # ExpressionStore straight from the per-sample files, for the segment plots without a combined TSV.
+    # Renames are applied to the p-value table's IDs as well.
+    from expression_store import ExpressionStore, load_pval_table
+    tpm_df = combine_segment_counts(input_dir, value, split_strands, renames)
+    pval_df = load_pval_table(pval_file)
+    if renames:
+        pval_df = pval_df.assign(ID=[segment_id(gene_id, None, False, renames) if gene_id.startswith('gene-') else gene_id
+                                     for gene_id in pval_df['ID'].astype(str)])
+    return ExpressionStore(tpm_df, pval_df, design)
+
+
+def parse_renames(items):
+    # ['N1=NA', 'M1=MP'] -> {'N1': 'NA', 'M1': 'MP'}
+    renames = {}
+    for item in items:
+        old, sep, new = item.partition('=')
+        if not sep or not old or not new:
+            raise ValueError(f"Rename {item!r} is not OLD=NEW")
+        renames[old] = new
+    return renames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Combine the per-sample segment *.counts.tpm.tsv files into one table (replaces combine-counts-segments*.rb).')
+    parser.add_argument('input_dir', help='folder with the <condition>_rep<N>.counts.tpm.tsv files, e.g. input-data/segments-strand2')
+    parser.add_argument('output', help='table to write, e.g. input-data/counts-tpm-segments.tsv')
+    parser.add_argument('--value', choices=['TPM', 'count', 'recomputed'], default='TPM',
+                        help='TPM column of the files (default), raw counts, or TPM recomputed from count and length over the features in each file')
+    parser.add_argument('--split-strands', action='store_true', help='name segments vRNA-<segment> (+ strand) and mRNA-<segment> (- strand)')
+    parser.add_argument('--paper-names', action='store_true', help='rename N1/M1/NS1 to NA/MP/NS')
+    parser.add_argument('--rename', action='append', default=[], metavar='OLD=NEW', help='further segment renames (repeatable)')
+    parser.add_argument('--workers', type=int, default=None, help='files read in parallel (default: one thread per file, up to the number of cores)')
+    args = parser.parse_args()
+
+    renames = dict(SEGMENT_RENAMES) if args.paper_names else {}
+    renames.update(parse_renames(args.rename))
+    from combine_tpms import write_tpm_table
+    write_tpm_table(combine_segment_counts(args.input_dir, args.value, args.split_strands, renames, args.workers), args.output)
@@ -0,0 +1,174 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+# Opt-in per-stage timing and memory trace. Off unless RNASEQ_PROFILE names a trace file (or enable() is
+# called), then every stage(...) block appends one JSON line: pid, gene, stage, seconds and memory delta.
+# The variable is inherited by batch_render's worker processes, which append to the same file.
+PROFILE_ENV = 'RNASEQ_PROFILE'
+# Set to 1 for exact Python allocation deltas (tracemalloc, slow) instead of the RSS difference
+TRACEMALLOC_ENV = 'RNASEQ_PROFILE_TRACEMALLOC'
+
+_local = threading.local()
+_lock = threading.Lock()
+_records = []
+
+
+def current_rss_mb():
+    # Resident set size of this process, Linux /proc first, peak RSS from getrusage elsewhere
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError):
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def trace_path():
+    return os.environ.get(PROFILE_ENV) or None
+
+
+def enabled():
+    return trace_path() is not None
+
+
+def enable(path, use_tracemalloc=False):
+    # Starts a new trace file. Through the environment, so worker processes started afterwards trace as well
+    # (setting RNASEQ_PROFILE directly appends to an existing trace instead).
+    path = os.path.abspath(path)
+    open(path, 'w').close()
+    os.environ[PROFILE_ENV] = path
+    if use_tracemalloc:
+        os.environ[TRACEMALLOC_ENV] = '1'
+
+
+def _memory_mb():
+    if os.environ.get(TRACEMALLOC_ENV) == '1':
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return tracemalloc.get_traced_memory()[0] / 1024**2
+    return current_rss_mb()
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage:
+    def __init__(self, name, gene_id):
+        self.name = name
+        self.gene_id = gene_id
+
+    def __enter__(self):
+        self.memory = _memory_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        gene_id = self.gene_id if self.gene_id is not None else getattr(_local, 'gene', None)
+        record = {'pid': os.getpid(), 'gene': gene_id, 'stage': self.name,
+                  'seconds': seconds, 'mem_mb': _memory_mb() - self.memory}
+        with _lock:
+            _records.append(record)
+        return False
+
+
+def stage(name, gene_id=None):
+    # with stage('savefig_png'): ...  -- a shared no-op when profiling is off.
+    # The gene defaults to the one set by traced_gene() in this thread, writer threads pass it explicitly.
+    if not enabled():
+        return _null_stage
+    return _Stage(name, gene_id)
+
+
+class traced_gene:
+    """Tags the stages inside with a gene ID, records the gene's total as stage 'gene' and writes the trace."""
+
+    def __init__(self, gene_id):
+        self.gene_id = gene_id
+        self._stage = None
+
+    def __enter__(self):
+        if enabled():
+            _local.gene = self.gene_id
+            self._stage = _Stage('gene', self.gene_id).__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        if self._stage is not None:
+            self._stage.__exit__(*exc)
+            _local.gene = None
+            flush()
+        return False
+
+
+def flush():
+    # Append the buffered records with one write, so lines of parallel workers do not interleave
+    global _records
+    path = trace_path()
+    with _lock:
+        records, _records = _records, []
+    if path is None or not records:
+        return
+    data = ''.join(json.dumps(record) + '\n' for record in records).encode()
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def read_trace(path):
+    with open(path) as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def summarize(records):
+    # p50/p95/max per stage; nested stages (e.g. 'gene' around 'savefig_png') overlap, so totals do not add up
+    by_stage = {}
+    for record in records:
+        by_stage.setdefault(record['stage'], []).append((record['seconds'], record['mem_mb']))
+    summary = {}
+    for name, values in by_stage.items():
+        seconds, memory = np.array(values).T
+        summary[name] = {
+            'count': len(values),
+            'total_s': float(seconds.sum()),
+            'p50_ms': float(np.percentile(seconds, 50) * 1000),
+            'p95_ms': float(np.percentile(seconds, 95) * 1000),
+            'max_ms': float(seconds.max() * 1000),
+            'mem_p50_mb': float(np.percentile(memory, 50)),
+            'mem_max_mb': float(memory.max()),
+        }
+    return summary
+
+
+def report(path=None, file=sys.stdout):
+    # End-of-run summary of the whole trace (all processes), also written as <trace>.summary.json
+    flush()
+    path = path or trace_path()
+    if path is None or not os.path.exists(path):
+        return None
+    summary = summarize(read_trace(path))
+    with open(f'{path}.summary.json', 'w') as fh:
+        json.dump(summary, fh, indent=1)
+    print(f"\n{'stage':<20}{'count':>7}{'total s':>10}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}{'mem p50':>9}{'mem max':>9}", file=file)
+    for name, row in sorted(summary.items(), key=lambda item: -item[1]['total_s']):
+        print(f"{name:<20}{row['count']:>7}{row['total_s']:>10.2f}{row['p50_ms']:>9.1f}{row['p95_ms']:>9.1f}{row['max_ms']:>9.1f}"
+              f"{row['mem_p50_mb']:>9.2f}{row['mem_max_mb']:>9.2f}", file=file)
+    print(f"trace: {path}, summary: {path}.summary.json (memory in MB)", file=file)
+    return summary
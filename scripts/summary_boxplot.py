@@ -0,0 +1,79 @@
+import matplotlib.pyplot as plt
+import seaborn as sns
+
+from design import default_design
+from figure_export import RASTER_DPI, print_file_reports, rasterize_dense_layers, save_figure
+from stage_profiler import stage
+
+
+def plot_combined_boxplot(all_data_df, pvals_dict, output_base='combined_summary_boxplot_with_pvalues', formats=('pdf', 'png', 'svg'), design=default_design,
+                          rasterize=None, raster_dpi=RASTER_DPI, report=False):
+    # One figure with all genes side by side, significance stars between the conditions of each gene.
+    # rasterize ('auto', 'points' or 'all', see figure_export.rasterize_dense_layers): layers as images at raster_dpi in PDF/SVG.
+    # Returns the FileReport of every written file, report=True also prints them.
+    custom_palette = design.palette
+
+    y_max = all_data_df['TPM'].max()
+    y_min = all_data_df['TPM'].min()
+    use_log_scale = y_max / max(y_min, 0.1) > 100
+
+    all_data_df['Virus_Gene'] = all_data_df['Gene'] + "\n" + all_data_df['Virus']
+
+    with stage('draw_boxes'):
+        plt.figure(figsize=(max(8, len(all_data_df['Virus_Gene'].unique()) * 0.8), 6))
+        ax = sns.boxplot(x='Virus_Gene', y='TPM', hue='Virus', data=all_data_df, palette=custom_palette, dodge=False)
+
+        sns.stripplot(
+            x='Virus_Gene', y='TPM', 
+            data=all_data_df, 
+            color='black', 
+            size=4, jitter=True,
+            dodge=False,
+            ax=ax
+        )
+        if rasterize:
+            rasterize_dense_layers(ax, rasterize)
+
+    if use_log_scale:
+        plt.yscale('log')
+        plt.ylabel('Expression level (TPM, log scale)')
+    else:
+        plt.ylabel('Expression level (TPM)')
+
+    plt.xticks(rotation=45, ha='right')
+    plt.title('Summary Boxplot of All Genes')
+    plt.legend(title='Virus', bbox_to_anchor=(1.05, 1), loc='upper left')
+
+    # p-value annotations
+    offset_counter = 0
+    bar_height_factor = 0.85
+
+    virus_gene_labels = all_data_df['Virus_Gene'].unique().tolist()
+    label_to_pos = {label: i for i, label in enumerate(virus_gene_labels)}
+
+    for gene, pval_data in pvals_dict.items():
+        # only the significant comparisons, parsed and classified once for the whole p-value table
+        for cond1, cond2, _, _, _, stars in pval_data:
+            label1 = f"{gene}\n{cond1}"
+            label2 = f"{gene}\n{cond2}"
+
+            if label1 not in label_to_pos or label2 not in label_to_pos:
+                continue
+
+            x1 = label_to_pos[label1]
+            x2 = label_to_pos[label2]
+
+            # Calculate height
+            y = y_max * (1.05 + offset_counter * bar_height_factor) if use_log_scale else y_max + (offset_counter * bar_height_factor * (y_max - y_min))
+
+            ax.plot([x1, x1, x2, x2], [y, y + (y*0.05), y + (y*0.05), y], lw=1.2, c='black')
+            ax.text((x1 + x2) / 2, y + (y*0.1), f"{stars}", ha='center', va='bottom', fontsize=9)
+
+            offset_counter += 1
+
+    with stage('tight_layout'):
+        plt.tight_layout()
+    reports = [save_figure(plt.gcf(), f'{output_base}.{fmt}', fmt, raster_dpi=raster_dpi if rasterize else None) for fmt in formats]
+    if report:
+        print_file_reports(reports)
+    return reports
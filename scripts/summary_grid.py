@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import os
+import time
+
+import matplotlib
+matplotlib.use('Agg')  # pages are written to files only
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+
+from expression_store import ExpressionStore
+from design import Design
+from figure_export import RASTER_DPI, RASTER_MODES, FileReport, atomic_output, print_file_reports, rasterize_dense_layers, save_figure, vector_dpi
+from gene_lists import read_gene_list
+from gene_stats import GeneStats
+from stage_profiler import stage, traced_gene
+from tpm_boxplot import draw_boxes_matplotlib
+
+GRID_FORMATS = ('pdf', 'png', 'svg')
+
+
+def draw_gene_facet(ax, store, stats, gene_id, use_log_scale=None, rasterize=None):
+    # One small-multiples panel: boxes, points and star brackets of a single gene.
+    # The number of brackets is bounded by the comparison columns, so every facet costs the same.
+    # Returns the upper y limit the brackets need, the caller applies it (shared axes need the page maximum).
+    row = stats.row(gene_id)
+    draw_boxes_matplotlib(ax, row, stats.conditions, store.design.palette)
+    if rasterize:
+        rasterize_dense_layers(ax, rasterize)
+    if use_log_scale is None:
+        use_log_scale = row['use_log_scale']
+    if use_log_scale:
+        ax.set_yscale('log')
+
+    y_range = row['y_range']
+    base_height = row['y_max'] * 1.5 if use_log_scale else row['y_max'] + 0.05 * y_range
+    positions = {cond: i for i, cond in enumerate(stats.conditions)}
+    top = None
+    offset_counter = 0
+    for cond1, cond2, _, _, _, stars in store.significance().row(gene_id):
+        if cond1 not in positions or cond2 not in positions:
+            continue
+        x1, x2 = positions[cond1], positions[cond2]
+        if use_log_scale:
+            y = base_height * 2.2 ** offset_counter
+            bar_height = y * 0.15
+        else:
+            y = base_height + offset_counter * 0.12 * y_range
+            bar_height = 0.02 * y_range
+        ax.plot([x1, x1, x2, x2], [y, y + bar_height, y + bar_height, y], lw=0.8, c='black')
+        ax.text((x1 + x2) / 2, y + bar_height, stars, ha='center', va='bottom', fontsize=7)
+        top = y + bar_height
+        offset_counter += 1
+
+    gene_name = store.gene_name(gene_id)
+    ax.set_title(gene_id if gene_name == gene_id else f'{gene_name}\n{gene_id}', fontsize=8)
+    ax.tick_params(which='both', labelsize=7)
+
+    # Room for the brackets and their stars
+    if top is None:
+        return None
+    return top * 2 if use_log_scale else top + 0.08 * y_range
+
+
+def draw_grid_page(store, stats, gene_ids, ncols=4, nrows=3, sharey=False, facet_size=(2.2, 2.2), rasterize=None):
+    # Fixed grid per page: a short last page keeps the same layout with empty facets hidden
+    fig = Figure(figsize=(ncols * facet_size[0], nrows * facet_size[1]))
+    FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows, ncols, sharex=True, sharey=sharey, squeeze=False).ravel()
+
+    # Shared y axes need one scale for the whole page
+    page_log_scale = None
+    if sharey:
+        page_log_scale = any(stats.row(gene_id)['use_log_scale'] for gene_id in gene_ids)
+    tops = []
+    for ax, gene_id in zip(axes, gene_ids):
+        top = draw_gene_facet(ax, store, stats, gene_id, page_log_scale, rasterize)
+        if top is not None:
+            tops.append(top)
+            if not sharey:
+                ax.set_ylim(top=top)
+    if sharey and tops:
+        axes[0].set_ylim(top=max(max(tops), axes[0].get_ylim()[1]))
+    for ax in axes[len(gene_ids):]:
+        ax.set_visible(False)
+
+    for ax in axes[-ncols:]:
+        ax.tick_params(axis='x', labelrotation=45)
+    for ax in axes[::ncols]:
+        ax.set_ylabel('TPM', fontsize=8)
+    # Fixed margins in inches instead of a tight_layout pass per page
+    width, height = fig.get_size_inches()
+    fig.subplots_adjust(left=0.55 / width, right=1 - 0.1 / width, bottom=0.75 / height, top=1 - 0.4 / height,
+                        wspace=0.35, hspace=0.5)
+    return fig
+
+
+def render_grid_pages(store, gene_ids, output_base, genes_per_page=12, ncols=4, formats=('pdf', 'png'), design=None, sharey=False, dpi=300,
+                      rasterize=None, raster_dpi=RASTER_DPI, report=False):
+    # Streams the genes page by page: the PDF gets one page each, PNG/SVG one numbered file each
+    # ({output_base}.page001.png, ...). Returns the written file names, report=True prints their size and write time.
+    # rasterize ('auto', 'points' or 'all', see figure_export.rasterize_dense_layers): layers as images at raster_dpi in PDF/SVG.
+    unknown = set(formats) - set(GRID_FORMATS)
+    if unknown:
+        raise ValueError(f"Unsupported output format(s): {', '.join(sorted(unknown))}")
+
+    found = []
+    for gene_id in gene_ids:
+        if gene_id in store:
+            found.append(gene_id)
+        else:
+            print(f"Gene ID '{gene_id}' not found.")
+    if not found:
+        return []
+
+    # Box statistics and scaling of all requested genes in one pass
+    stats = GeneStats.from_store(store, found, design)
+    nrows = -(-min(genes_per_page, len(found)) // ncols)
+    n_pages = -(-len(found) // genes_per_page)
+
+    written = []
+    reports = []
+    pdf = None
+    pdf_seconds = 0.0
+    raster_dpi = raster_dpi if rasterize else None
+    with contextlib.ExitStack() as output:
+        if 'pdf' in formats:
+            # the multi-page PDF only appears under its name once the last page is written
+            pdf = PdfPages(output.enter_context(atomic_output(f'{output_base}.pdf')))
+            written.append(f'{output_base}.pdf')
+        try:
+            for page in range(n_pages):
+                start = time.perf_counter()
+                page_genes = found[page * genes_per_page:(page + 1) * genes_per_page]
+                # pages take the place of genes in the stage trace
+                with traced_gene(f'page{page + 1:03d}'):
+                    with stage('draw_page'):
+                        fig = draw_grid_page(store, stats, page_genes, ncols, nrows, sharey, rasterize=rasterize)
+                    if pdf is not None:
+                        pdf_start = time.perf_counter()
+                        with stage('savefig_pdf'):
+                            pdf.savefig(fig, dpi=vector_dpi(raster_dpi))
+                        pdf_seconds += time.perf_counter() - pdf_start
+                    for fmt in formats:
+                        if fmt == 'pdf':
+                            continue
+                        path = f'{output_base}.page{page + 1:03d}.{fmt}'
+                        reports.append(save_figure(fig, path, fmt, dpi, raster_dpi))
+                        written.append(path)
+                print(f"Page {page + 1}/{n_pages}: {len(page_genes)} genes in {time.perf_counter() - start:.2f} s")
+        finally:
+            if pdf is not None:
+                pdf_start = time.perf_counter()
+                pdf.close()
+                pdf_seconds += time.perf_counter() - pdf_start
+    if pdf is not None and os.path.exists(f'{output_base}.pdf'):
+        reports.insert(0, FileReport(f'{output_base}.pdf', os.path.getsize(f'{output_base}.pdf'), pdf_seconds))
+    if report:
+        print_file_reports(reports)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plot many genes as pages of small TPM boxplots with significance stars.')
+    parser.add_argument('tpm_file')
+    parser.add_argument('pval_file')
+    parser.add_argument('--genes', nargs='+', help='gene IDs to plot')
+    parser.add_argument('--genes-file', help='file with one gene ID per line')
+    parser.add_argument('--output', default='combined_summary_boxplot_grid', help='output file base name')
+    parser.add_argument('--per-page', type=int, default=12, help='genes per page')
+    parser.add_argument('--ncols', type=int, default=4, help='facets per row')
+    parser.add_argument('--formats', nargs='+', default=['pdf', 'png'], choices=GRID_FORMATS, help='pdf is one multi-page file, png/svg one file per page')
+    parser.add_argument('--sharey', action='store_true', help='same y axis for all genes of a page')
+    parser.add_argument('--no-mock', action='store_true', help='leave out the mock condition (e.g. for the segments)')
+    parser.add_argument('--design', help='conditions, replicate columns, colors and comparisons as JSON (default: mock/avian/swine/reass)')
+    parser.add_argument('--rasterize', nargs='?', const='auto', choices=RASTER_MODES,
+                        help='dense points (auto), all points, or points and boxes (all) as images in pdf/svg, text and axes stay vectors')
+    parser.add_argument('--raster-dpi', type=int, default=RASTER_DPI, help='resolution of the rasterized layers')
+    parser.add_argument('--report', action='store_true', help='print size and write time of every output file')
+    args = parser.parse_args()
+
+    gene_ids = list(args.genes or [])
+    if args.genes_file:
+        gene_ids += read_gene_list(args.genes_file)
+    store = ExpressionStore.from_files(args.tpm_file, args.pval_file, design=Design.from_json(args.design) if args.design else None)
+    if not gene_ids:
+        gene_ids = store.gene_ids()
+    design = store.design.without('Mock') if args.no_mock else None
+
+    np.random.seed(0)  # same jitter on every run
+    render_grid_pages(store, gene_ids, args.output, args.per_page, args.ncols, args.formats, design, args.sharey,
+                      rasterize=args.rasterize, raster_dpi=args.raster_dpi, report=args.report)
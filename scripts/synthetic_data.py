@@ -0,0 +1,77 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# The four real conditions come first (same column order as tpms-human.tsv), any further ones are made up
+BASE_CONDITIONS = ['mock', 'swine', 'avian', 'reass']
+# Same columns as pvals-virus-comparisons.tsv
+BASE_COMPARISONS = ['avian-reass', 'reass-swine', 'avian-swine']
+
+
+def condition_names(n_conditions):
+    return BASE_CONDITIONS[:n_conditions] + [f'virus{i}' for i in range(len(BASE_CONDITIONS) + 1, n_conditions + 1)]
+
+
+def make_tables(n_genes, n_conditions=4, n_reps=3, seed=0):
+    # TPM and adjusted p-value tables shaped like tpms-human.tsv and pvals-virus-comparisons.tsv:
+    # log-normal expression with per-condition fold changes, a share of unexpressed genes and empty
+    # names, and p-values with significant hits and NA rows (genes DESeq2 filtered out)
+    rng = np.random.default_rng(seed)
+    conditions = condition_names(n_conditions)
+    ids = np.array([f'ENSG{i:011d}' for i in range(1, n_genes + 1)])
+
+    names = np.array([f'SYN{i}' for i in range(1, n_genes + 1)], dtype=object)
+    names[rng.random(n_genes) < 0.4] = ''
+
+    base = 10 ** rng.normal(0.5, 1.2, size=(n_genes, 1, 1))
+    fold = 2 ** rng.normal(0, 0.7, size=(n_genes, n_conditions, 1))
+    noise = rng.lognormal(0, 0.3, size=(n_genes, n_conditions, n_reps))
+    tpm = base * fold * noise
+    silent = rng.random(n_genes) < 0.2
+    tpm[silent] *= rng.random((silent.sum(), n_conditions, n_reps)) < 0.1
+    tpm_df = pd.DataFrame(tpm.reshape(n_genes, -1), columns=[f'{cond}-rep{rep}' for cond in conditions for rep in range(1, n_reps + 1)])
+    tpm_df.insert(0, 'Name', names)
+    tpm_df.insert(0, 'ID', ids)
+
+    comparisons = BASE_COMPARISONS if n_conditions >= 4 else []
+    comparisons = comparisons + [f'{cond}-reass' for cond in conditions[len(BASE_CONDITIONS):]]
+    # About half of the genes are in the p-value table, like the DESeq2 output against all annotated genes
+    in_pvals = np.sort(rng.choice(n_genes, size=n_genes // 2, replace=False))
+    pvals = rng.uniform(size=(len(in_pvals), len(comparisons)))
+    hits = rng.random(pvals.shape) < 0.15
+    pvals[hits] = 10 ** -rng.uniform(1.5, 15, size=hits.sum())
+    pvals[rng.random(len(in_pvals)) < 0.4] = np.nan
+    pval_df = pd.DataFrame(pvals, columns=comparisons)
+    pval_df.insert(0, 'ID', ids[in_pvals])
+    return tpm_df, pval_df
+
+
+def table_paths(out_dir, n_genes, n_conditions=4, n_reps=3, seed=0):
+    base = os.path.join(out_dir, f'synthetic-{n_genes}g-{n_conditions}c-{n_reps}r-s{seed}')
+    return f'{base}-tpms.tsv', f'{base}-pvals.tsv'
+
+
+def write_tables(out_dir, n_genes, n_conditions=4, n_reps=3, seed=0, overwrite=False):
+    # Returns (tpm_file, pval_file), existing tables of the same shape and seed are reused
+    tpm_file, pval_file = table_paths(out_dir, n_genes, n_conditions, n_reps, seed)
+    if overwrite or not (os.path.exists(tpm_file) and os.path.exists(pval_file)):
+        os.makedirs(out_dir, exist_ok=True)
+        tpm_df, pval_df = make_tables(n_genes, n_conditions, n_reps, seed)
+        tpm_df.to_csv(tpm_file, sep="\t", index=False)
+        pval_df.to_csv(pval_file, sep="\t", index=False, na_rep='NA')
+    return tpm_file, pval_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic TPM and p-value tables for benchmarks.')
+    parser.add_argument('out_dir')
+    parser.add_argument('--genes', type=int, default=60000, help='number of genes (1k-250k)')
+    parser.add_argument('--conditions', type=int, default=4, help='number of conditions (4-20), the first four are mock/swine/avian/reass')
+    parser.add_argument('--reps', type=int, default=3, help='replicates per condition (3-10)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    paths = write_tables(args.out_dir, args.genes, args.conditions, args.reps, args.seed, overwrite=True)
+    print('\n'.join(paths))
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Bump when the on-disk layout changes, old cache entries are then rebuilt
+CACHE_VERSION = 1
+
+# Cache entries live next to the source table unless this is set
+CACHE_DIR_ENV = 'RNASEQ_TABLE_CACHE'
+
+
+def _cache_dir_for(path, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_ENV) or os.path.join(os.path.dirname(os.path.abspath(path)), '.table-cache')
+    return cache_dir
+
+
+def source_key(path, reader, extra_sources=()):
+    # Any change of path, size, mtime or parsing function gives a new key,
+    # the same goes for any further file the reader depends on
+    token = f"{CACHE_VERSION}|{reader.__module__}.{reader.__qualname__}"
+    for source in (path, *extra_sources):
+        stat = os.stat(source)
+        token += f"|{os.path.abspath(source)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(token.encode()).hexdigest()[:16]
+
+
+def _entry_prefix(path, reader, extra_sources=()):
+    # Entries with the same prefix are versions of each other (write_entry drops the older ones), so every
+    # source file is part of it: the same TPM table with another p-value table is a separate entry
+    token = f"{os.path.abspath(path)}|{reader.__module__}.{reader.__qualname__}"
+    for source in extra_sources:
+        token += f"|{os.path.abspath(source)}"
+    path_hash = hashlib.sha1(token.encode()).hexdigest()[:8]
+    return f"{os.path.basename(path)}.{path_hash}."
+
+
+def _save_table(df, entry):
+    columns = []
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        info = {'name': col, 'file': f'{i}.npy'}
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            info['kind'] = 'category'
+        if pd.api.types.is_numeric_dtype(series.dtype) and not isinstance(series.dtype, pd.CategoricalDtype):
+            values = series.to_numpy()
+        else:
+            # Strings are stored as fixed-width unicode, no pickling needed on load
+            missing = series.isna().to_numpy()
+            values = series.astype(object).where(~missing, '').to_numpy(dtype=str)
+            if missing.any():
+                info['missing'] = f'{i}.missing.npy'
+                np.save(os.path.join(entry, info['missing']), missing)
+        np.save(os.path.join(entry, info['file']), values)
+        columns.append(info)
+    with open(os.path.join(entry, 'meta.json'), 'w') as fh:
+        json.dump({'version': CACHE_VERSION, 'rows': len(df), 'columns': columns}, fh)
+
+
+def _load_table(entry):
+    with open(os.path.join(entry, 'meta.json')) as fh:
+        meta = json.load(fh)
+    data = {}
+    for info in meta['columns']:
+        values = np.load(os.path.join(entry, info['file']))
+        if values.dtype.kind == 'U':
+            values = values.astype(object)
+            if 'missing' in info:
+                values[np.load(os.path.join(entry, info['missing']))] = np.nan
+        column = pd.Series(values)
+        if info.get('kind') == 'category':
+            column = column.astype('category')
+        data[info['name']] = column
+    return pd.DataFrame(data)
+
+
+def cache_entry(path, reader, cache_dir=None, extra_sources=()):
+    # Folder of the cache entry for this source file (+ extra sources) and reader
+    cache_dir = _cache_dir_for(path, cache_dir)
+    return os.path.join(cache_dir, _entry_prefix(path, reader, extra_sources) + source_key(path, reader, extra_sources))
+
+
+def write_entry(entry, save):
+    # save(folder) fills a temp dir that is renamed to the entry, so a crashed run never leaves a half-written
+    # entry. Entries of older versions of the same source file and reader are dropped first.
+    cache_dir, name = os.path.split(entry)
+    prefix = name[:name.rindex('.') + 1]
+    os.makedirs(cache_dir, exist_ok=True)
+    for old in os.listdir(cache_dir):
+        if old.startswith(prefix) and old != name:
+            shutil.rmtree(os.path.join(cache_dir, old), ignore_errors=True)
+    tmp = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+    try:
+        save(tmp)
+        os.replace(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(entry):  # lost the race against a parallel worker is fine
+            raise
+
+
+def cached_read(path, reader, cache_dir=None, extra_sources=()):
+    # reader(path) -> DataFrame. Tables derived from several files (e.g. an index over a table
+    # plus an annotation file) list the other files in extra_sources so they invalidate the entry too.
+    entry = cache_entry(path, reader, cache_dir, extra_sources)
+
+    if os.path.isfile(os.path.join(entry, 'meta.json')):
+        try:
+            return _load_table(entry)
+        except (OSError, ValueError, KeyError):
+            shutil.rmtree(entry, ignore_errors=True)  # broken entry, rebuild below
+
+    df = reader(path)
+    try:
+        write_entry(entry, lambda folder: _save_table(df, folder))
+    except OSError as e:
+        print(f"Could not write table cache for {path}: {e}")
+    return df
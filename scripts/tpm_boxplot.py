@@ -0,0 +1,258 @@
+import colorsys
+import functools
+import gc
+import hashlib
+import numpy as np
+import matplotlib.pyplot as plt
+import seaborn as sns
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.transforms import Bbox
+from comparisons import significance_levels
+from design import default_design
+from figure_export import FORMATS, atomic_output
+from gene_stats import GeneStats
+from stage_profiler import current_rss_mb, stage, traced_gene
+
+# Colors and condition order come from the store's design (design.py)
+
+@functools.lru_cache(maxsize=None)
+def box_colors(colors):
+    # Box colors as seaborn draws them (saturation 0.75, gray lines from the lightest palette color),
+    # so the plain matplotlib backend gives the same figure
+    facecolors = []
+    for color in colors:
+        h, l, s = colorsys.rgb_to_hls(*color[:3])
+        facecolors.append(colorsys.hls_to_rgb(h, l, s * 0.75))
+    lum = min(colorsys.rgb_to_hls(*color[:3])[1] for color in colors) * 0.6
+    return facecolors, (lum, lum, lum)
+
+def draw_boxes_matplotlib(ax, row, conditions, palette=default_design.palette):
+    # Seaborn-free version of the sns.boxplot + sns.stripplot pair, straight from precomputed box stats
+    box_facecolors, box_linecolor = box_colors(tuple(palette[cond] for cond in conditions))
+    values = row['values']
+    box = row['box']
+    bxp_stats = []
+    for i, cond in enumerate(conditions):
+        fliers = values[i][(values[i] < box['whislo'][i]) | (values[i] > box['whishi'][i])]
+        bxp_stats.append({'q1': box['q1'][i], 'med': box['med'][i], 'q3': box['q3'][i],
+                          'whislo': box['whislo'][i], 'whishi': box['whishi'][i], 'fliers': fliers, 'label': cond})
+    line = dict(color=box_linecolor, linewidth=1.0)
+    artists = ax.bxp(bxp_stats, positions=range(len(conditions)), widths=0.8, capwidths=0.4, patch_artist=True, manage_ticks=False,
+                     boxprops=dict(edgecolor=box_linecolor, linewidth=1.0), medianprops=dict(line, zorder=2.1),
+                     whiskerprops=line, capprops=line,
+                     flierprops=dict(marker='o', markersize=6, markerfacecolor='none', markeredgecolor=box_linecolor))
+    for patch, facecolor in zip(artists['boxes'], box_facecolors):
+        patch.set_facecolor(facecolor)
+
+    # Jittered points, drawn like sns.stripplot (same random stream, one draw per condition)
+    for i, cond in enumerate(conditions):
+        jitter = np.random.uniform(low=-0.1, high=0.1, size=len(values[i])) if len(values[i]) > 1 else 0
+        ax.scatter(i + jitter, values[i], s=25, color='black', linewidths=0, zorder=3)
+
+    ax.set_xticks(range(len(conditions)), conditions)
+    ax.set_xlim(-0.5, len(conditions) - 0.5)
+    ax.xaxis.grid(False)
+
+def figure_size(design):
+    # 4x4 inches for the four virus conditions, wider for larger designs
+    return (max(4, 0.8 * len(design)), 4)
+
+def output_basename(store, gene_id):
+    gene_name = store.gene_name(gene_id)
+    safe_name = gene_name.replace(" ", "_").replace("/", "_")
+    return f'{safe_name}_{gene_id}'
+
+# Any edit to the drawing code invalidates previously rendered plots
+with open(__file__, 'rb') as _fh:
+    code_version = hashlib.sha1(_fh.read()).hexdigest()
+
+def render_params(formats=FORMATS, backend='seaborn', design=default_design):
+    # Everything besides the gene's own data that changes the written files
+    return {
+        'palette': design.palette,
+        'order': design.labels,
+        'significance': significance_levels,
+        'formats': sorted(formats),
+        'dpi': 300,
+        'backend': backend,
+        'code': code_version,
+    }
+
+# backend='seaborn' (default) or 'matplotlib' (no seaborn, faster per gene)
+def draw_tpm_boxplot(ax, store, gene_id, stats=None, backend='seaborn'):
+    # TPM and p-value tables are loaded once in the ExpressionStore and looked up by ID
+    if gene_id not in store:
+        print(f"Gene ID '{gene_id}' not found in one of the tables.")
+        return None
+
+    # Get gene name or fallback to ID
+    gene_name = store.gene_name(gene_id)
+    filename_base = output_basename(store, gene_id)
+
+    # TPM values per condition plus log-scale decision and bracket base, precomputed for
+    # a chunk of genes when a GeneStats is passed in (batch runs), else for this gene only
+    with stage('gene_stats'):
+        if stats is None or gene_id not in stats:
+            stats = GeneStats.from_store(store, [gene_id])
+        row = stats.row(gene_id)
+    values = row['values']
+    virus = np.repeat(stats.conditions, values.shape[1])
+    palette = store.design.palette
+
+    with stage('draw_boxes'):
+        if backend == 'matplotlib':
+            draw_boxes_matplotlib(ax, row, stats.conditions, palette)
+        else:
+            sns.boxplot(x=virus, y=values.ravel(), palette=palette, order=stats.conditions, ax=ax)
+            sns.stripplot(x=virus, y=values.ravel(), color='black', size=5, jitter=True, order=stats.conditions, ax=ax)
+    ax.set_xlabel('Virus')
+
+    y_max = row['y_max']
+    y_min = row['y_min']
+    y_range = row['y_range']
+    use_log_scale = row['use_log_scale']
+    base_height = row['base_height']
+
+    if use_log_scale:
+        ax.set_yscale('log')
+        ax.set_ylabel('Expression level (TPM, log scale)')
+    else:
+        ax.set_ylabel('Expression level (TPM)')
+
+    # Title: Gene name and ID
+    ax.set_title(f'{gene_name} ({gene_id})')
+
+    # Dynamic p-value annotation: comparison columns are parsed and classified once per store,
+    # only this gene's significant comparisons come back (x positions follow the design's condition order)
+    with stage('annotate'):
+        offset_counter = 0
+        log_y_positions = []
+
+        for _, _, x1, x2, pval, stars in store.significance().row(gene_id):
+            if use_log_scale:
+                if not log_y_positions:
+                    y = base_height
+                else:
+                    y = log_y_positions[-1] * 2.2
+                log_y_positions.append(y)
+                bar_height = y * 0.15
+            else:
+                y = base_height + offset_counter * 0.12 * y_range
+                bar_height = 0.02 * y_range
+
+            text_label = f"p={pval:.2g} ({stars})"
+            ax.plot([x1, x1, x2, x2], [y, y + bar_height, y + bar_height, y], lw=1.2, c='black')
+            ax.text((x1 + x2) / 2, y + bar_height * 1.05, text_label, ha='center', va='bottom', fontsize=9)
+
+            offset_counter += 1
+
+        # Extend y-limits to fit all annotations
+        if use_log_scale and log_y_positions:
+            ax.set_ylim(y_min, log_y_positions[-1] * 2)
+        elif not use_log_scale:
+            current_ylim = ax.get_ylim()
+            ax.set_ylim(current_ylim[0], current_ylim[1] + 0.05 * y_range)
+
+    return filename_base
+
+def plot_tpm_boxplot(store, gene_id, formats=FORMATS, manifest=None, stats=None, backend='seaborn', exporter=None):
+    # With a RenderManifest, genes whose data, settings and files are unchanged are skipped.
+    # With a FigureExporter (its formats are used) the files are written in the background while the next gene is drawn.
+    if exporter is not None:
+        formats = exporter.formats
+    if manifest is not None and gene_id in store and manifest.is_current(store, gene_id, output_basename(store, gene_id), render_params(formats, backend, store.design)):
+        print(f"Skipping {gene_id}, plots are up to date.")
+        return
+
+    with traced_gene(gene_id):
+        fig = plt.figure(figsize=figure_size(store.design))
+        filename_base = draw_tpm_boxplot(fig.gca(), store, gene_id, stats, backend)
+        if filename_base is None:
+            plt.close(fig)
+            return
+
+        with stage('tight_layout'):
+            plt.tight_layout()
+
+        # Save outputs
+        if exporter is not None:
+            exporter.export(fig, f'boxplot.{filename_base}', key=gene_id)
+        else:
+            for fmt in formats:
+                with stage(f'savefig_{fmt}'), atomic_output(f'boxplot.{filename_base}.{fmt}') as tmp:
+                    plt.savefig(tmp, format=fmt, dpi=300 if fmt == 'png' else 'figure')
+        # plt.show()  # Uncomment if you want interactive plots
+        plt.close(fig)  # open pyplot figures are never freed otherwise
+    if manifest is not None:
+        manifest.record(store, gene_id, filename_base, render_params(formats, backend, store.design))
+
+class BoxplotTemplate:
+    """One reusable figure for batch rendering, only the per-gene artists are swapped."""
+
+    def __init__(self, figsize=None, max_rss_mb=None, design=default_design):
+        self.figsize = figsize or figure_size(design)
+        self.max_rss_mb = max_rss_mb
+        self.labels = design.labels
+        self._build()
+
+    def _build(self):
+        # A bare Figure is not registered with pyplot, so nothing accumulates in plt's figure manager
+        self.fig = Figure(figsize=self.figsize)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot()
+        # Fixed layout instead of a tight_layout pass per gene, side margins in inches of the 4x4 plot
+        width = self.figsize[0]
+        self.fig.subplots_adjust(left=0.68 / width, right=1 - 0.08 / width, bottom=0.12, top=0.91)
+        self.ax.set_xticks(range(len(self.labels)), self.labels)
+        self.ax.set_xlim(-0.5, len(self.labels) - 0.5)
+        self.ax.set_xlabel('Virus')
+        self._static = set(self.ax.get_children())
+        self._artists = []
+
+    def _clear(self):
+        for artist in self._artists:
+            artist.remove()
+        self._artists = []
+        # seaborn also registers its box artists as containers, which would keep them alive
+        self.ax.containers.clear()
+        # Forget the previous gene's data limits and scale
+        self.ax.set_yscale('linear')
+        self.ax.ignore_existing_data_limits = True
+        self.ax.dataLim.set_points(Bbox.null().get_points())
+        self.ax.set_autoscaley_on(True)
+
+    def reset(self):
+        self.fig.clear()
+        self._build()
+        gc.collect()
+
+    def draw(self, store, gene_id, stats=None, backend='seaborn'):
+        # Swap in the new gene's artists, returns the output file base name (None if the gene is unknown)
+        with stage('clear'):
+            self._clear()
+        filename_base = draw_tpm_boxplot(self.ax, store, gene_id, stats, backend)
+        self._artists = [artist for artist in self.ax.get_children() if artist not in self._static]
+        return filename_base
+
+    def render(self, store, gene_id, exporter=None, formats=FORMATS, key=None, stats=None, backend='seaborn'):
+        filename_base = self.draw(store, gene_id, stats, backend)
+        if filename_base is None:
+            return None
+
+        if exporter is not None:
+            # The exporter draws now and writes the files in the background
+            exporter.export(self.fig, f'boxplot.{filename_base}', key=key)
+        else:
+            for fmt in formats:
+                with stage(f'savefig_{fmt}'), atomic_output(f'boxplot.{filename_base}.{fmt}') as tmp:
+                    self.fig.savefig(tmp, format=fmt, dpi=300 if fmt == 'png' else 'figure')
+        self.check_rss(gene_id)
+        return filename_base
+
+    def check_rss(self, gene_id):
+        # Over the ceiling: throw away the figure and all cached renderer state, MemoryError if that does not help
+        if self.max_rss_mb is not None and current_rss_mb() > self.max_rss_mb:
+            self.reset()
+            if current_rss_mb() > self.max_rss_mb:
+                raise MemoryError(f"RSS {current_rss_mb():.0f} MB above the {self.max_rss_mb} MB ceiling after rendering {gene_id}")